@@ -0,0 +1,364 @@
+"""
+In-process benchmarks of the filesystem. A synthetic flumes database is
+generated and the paths are resolved and served the same way the mount does,
+without the kernel, so no FUSE privileges are needed.
+
+Run it with
+    python benchmarks/bench.py [--files N] [--save FILE] [--compare FILE]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from stat import S_ISDIR
+
+from flumes.config import Config
+from flumes.options import Options
+from flumes.schema import Audio, Field, File, Info, Meta, Schema, Video
+from sqlalchemy import event
+
+from flumes_fuse.db import Database
+from flumes_fuse.files import FilePool, Prefetcher
+from flumes_fuse.options import mount_options
+from flumes_fuse.path import PathParser, TreeTablePath
+from flumes_fuse.registry import build_registry, parse_load_plan
+from flumes_fuse.tree import FileContent, Root
+
+# Size of the reads the kernel does on the files
+READ_SIZE = 128 * 1024
+
+
+def create_config(path):
+    options = Options()
+    return Config(options.parse_args(["-i", "sqlite:///{}".format(path)]))
+
+
+def generate(
+    config, media_root, files=1000, streams=2, cardinality=10, media=4, media_size=0
+):
+    """
+    Fill a flumes database with files having the given number of streams,
+    alternating audio and video. The values of the stream fields take
+    cardinality distinct values. The files point to media files of
+    media_size bytes created in media_root
+    """
+    names = []
+    for i in range(media):
+        names.append("media-{}.bin".format(i))
+        with open(os.path.join(media_root, names[-1]), "wb") as f:
+            f.write(os.urandom(media_size))
+
+    schema = Schema(config)
+    session = schema.create_session()
+    session.add(Meta(version="0.1.4", root=media_root))
+    rand = random.Random(0)
+    mtime = datetime(2022, 1, 1)
+    for i in range(files):
+        f = File(name=names[i % media], path="", mtime=mtime)
+        info = Info(
+            file=f,
+            duration=rand.randrange(cardinality) * 1000000000,
+            seekable=True,
+            live=False,
+            audio_streams=(streams + 1) // 2,
+            video_streams=streams // 2,
+            subtitle_streams=0,
+        )
+        for j in range(streams):
+            value = rand.randrange(cardinality)
+            if j % 2:
+                stream = Video(
+                    info=info,
+                    media_type="video/x-codec-{}".format(value),
+                    width=320 * (value + 1),
+                    height=240 * (value + 1),
+                )
+            else:
+                stream = Audio(
+                    info=info,
+                    media_type="audio/x-codec-{}".format(value),
+                    channels=value + 1,
+                    bitrate=32000 * (value + 1),
+                )
+            Field(stream=stream, name="tag", value="value-{}".format(value))
+        session.add(f)
+        if i % 1000 == 999:
+            session.commit()
+    session.commit()
+    session.close()
+
+
+class Recorder(object):
+    """
+    Latencies of the operations of a workload and the statements they issue
+    """
+
+    def __init__(self, engine):
+        self.latencies = []
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self._statement)
+
+    def _statement(self, *args):
+        self.statements += 1
+
+    def measure(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        ops = len(latencies)
+
+        def percentile(p):
+            return latencies[min(ops - 1, int(ops * p))] * 1000 if ops else 0
+
+        return {
+            "ops": ops,
+            "ops_per_sec": ops / elapsed if elapsed else 0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "sql_per_op": self.statements / ops if ops else 0,
+        }
+
+
+class Operations(object):
+    """
+    The operations of the mount on top of a PathParser
+    """
+
+    def __init__(self, path_parser):
+        self.path_parser = path_parser
+
+    def getattr(self, path):
+        attr = self.path_parser.get_attr(path)
+        if attr:
+            return attr
+        try:
+            return self.path_parser.parse(path).getattr()
+        finally:
+            self.path_parser.release()
+
+    def readdir(self, path):
+        try:
+            entries = list(self.path_parser.parse(path).readdir(0))
+            self.path_parser.put_attrs(path, entries)
+            return [e.name for e in entries]
+        finally:
+            self.path_parser.release()
+
+    def read(self, path, size, offset):
+        try:
+            return self.path_parser.parse(path).read(size, offset)
+        finally:
+            self.path_parser.release()
+
+    def open(self, path):
+        try:
+            return self.path_parser.parse(path).open(os.O_RDONLY)
+        finally:
+            self.path_parser.release()
+
+
+def walk(ops, recorder, limit):
+    """
+    List every directory and stat every entry, like find does
+    """
+    pending = ["/"]
+    while pending and len(recorder.latencies) < limit:
+        path = pending.pop()
+        attr = recorder.measure(ops.getattr, path)
+        if not S_ISDIR(attr.st_mode):
+            continue
+        for name in recorder.measure(ops.readdir, path):
+            if name in [".", ".."]:
+                continue
+            pending.append(os.path.join(path, name))
+
+
+def search(ops, recorder, limit):
+    """
+    Drill down every value of a searchable field and stat its results
+    """
+    while len(recorder.latencies) < limit:
+        for query in ["/search/audio/channels", "/search/video/width"]:
+            for value in recorder.measure(ops.readdir, query)[2:]:
+                results = "{}/{}/results".format(query, value)
+                for name in recorder.measure(ops.readdir, results)[2:12]:
+                    recorder.measure(ops.getattr, "{}/{}".format(results, name))
+
+
+def fields(ops, recorder, limit, files):
+    """
+    Read the fields of random files
+    """
+    rand = random.Random(0)
+    paths = ["info/duration", "info/seekable", "name", "mtime", "info/streams"]
+    while len(recorder.latencies) < limit:
+        path = "/files/{}/{}".format(rand.randint(1, files), rand.choice(paths))
+        if path.endswith("streams"):
+            recorder.measure(ops.readdir, path)
+        else:
+            recorder.measure(ops.read, path, READ_SIZE, 0)
+
+
+def stream(ops, recorder, limit, files):
+    """
+    Read the contents of files sequentially, like a player does
+    """
+    rand = random.Random(0)
+    while len(recorder.latencies) < limit:
+        path = "/files/{}/contents".format(rand.randint(1, files))
+        handle = recorder.measure(ops.open, path)
+        try:
+            offset = 0
+            while len(recorder.latencies) < limit:
+                data = recorder.measure(handle.read, READ_SIZE, offset)
+                if not data:
+                    break
+                offset += len(data)
+        finally:
+            handle.release()
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        config = create_config(os.path.join(tmp, "flumes.db"))
+        start = time.perf_counter()
+        generate(
+            config,
+            tmp,
+            files=args.files,
+            streams=args.streams,
+            cardinality=args.cardinality,
+            media_size=args.media_size,
+        )
+        print(
+            "Generated {} files in {:.1f}s".format(
+                args.files, time.perf_counter() - start
+            )
+        )
+
+        build_registry()
+        TreeTablePath.load_plan = parse_load_plan(args.load_plan)
+        FileContent.pool = FilePool()
+        FileContent.prefetcher = Prefetcher()
+        workloads = [
+            ("walk", lambda o, r: walk(o, r, args.ops)),
+            ("search", lambda o, r: search(o, r, args.ops)),
+            ("fields", lambda o, r: fields(o, r, args.ops, args.files)),
+            ("stream", lambda o, r: stream(o, r, args.ops, args.files)),
+        ]
+        results = {}
+        try:
+            for name, workload in workloads:
+                if args.workload and name not in args.workload:
+                    continue
+                # Every workload starts with cold caches
+                schema = Database(config)
+                recorder = Recorder(schema.engine)
+                ops = Operations(PathParser(schema, Root, cache_size=args.cache_size))
+                start = time.perf_counter()
+                workload(ops, recorder)
+                results[name] = recorder.report(time.perf_counter() - start)
+                schema.engine.dispose()
+        finally:
+            FileContent.prefetcher.shutdown()
+            FileContent.pool.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Workloads slower or issuing more statements than in the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["sql_per_op"] > base["sql_per_op"] * 1.01:
+            regressions.append(
+                "{}: {:.2f} statements per op, was {:.2f}".format(
+                    name, result["sql_per_op"], base["sql_per_op"]
+                )
+            )
+        for key in ["p50_ms", "p99_ms"]:
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    "{}: {} {:.3f}ms, was {:.3f}ms".format(
+                        name, key, result[key], base[key]
+                    )
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=2000, help="number of files")
+    parser.add_argument("--streams", type=int, default=2, help="streams per file")
+    parser.add_argument(
+        "--cardinality", type=int, default=10, help="distinct values per field"
+    )
+    parser.add_argument(
+        "--media-size", type=int, default=8 * 1024 * 1024, help="media file size"
+    )
+    parser.add_argument("--ops", type=int, default=2000, help="ops per workload")
+    parser.add_argument("--cache-size", type=int, default=4096, help="path cache")
+    parser.add_argument(
+        "--load-plan",
+        default=dict([(o[0], o[1]) for o in mount_options])["load_plan"],
+        help="how to load the relationships",
+    )
+    parser.add_argument(
+        "--workload", action="append", help="workload to run, all by default"
+    )
+    parser.add_argument("--save", help="store the results as baseline")
+    parser.add_argument("--compare", help="baseline to compare the results with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="latency increase allowed over the baseline",
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    print(
+        "{:<8} {:>8} {:>10} {:>9} {:>9} {:>8}".format(
+            "workload", "ops", "ops/s", "p50 ms", "p99 ms", "sql/op"
+        )
+    )
+    for name, r in results.items():
+        print(
+            "{:<8} {:>8} {:>10.0f} {:>9.3f} {:>9.3f} {:>8.2f}".format(
+                name,
+                r["ops"],
+                r["ops_per_sec"],
+                r["p50_ms"],
+                r["p99_ms"],
+                r["sql_per_op"],
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print("Regression on {}".format(r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
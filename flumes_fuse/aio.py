@@ -0,0 +1,229 @@
+"""
+Backend on top of pyfuse3 and asyncio. The requests are served by the same
+tree of paths as the fuse-python backend, many of them at once: the database
+work runs on a pool of threads and the reads of the media files on another
+one, so the lookups do not wait behind slow reads
+"""
+import asyncio
+import errno
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyfuse3
+import pyfuse3.asyncio
+
+from .files import FileHandle
+from .options import kernel_cache_options
+
+logger = logging.getLogger(__name__)
+
+
+def to_entry_attributes(stat, timeouts):
+    entry = pyfuse3.EntryAttributes()
+    for name in ["st_ino", "st_mode", "st_nlink", "st_uid", "st_gid", "st_size"]:
+        setattr(entry, name, getattr(stat, name))
+    for name in ["st_atime", "st_mtime", "st_ctime"]:
+        setattr(entry, name + "_ns", int(getattr(stat, name) * 10**9))
+    entry.attr_timeout = timeouts["attr_timeout"]
+    entry.entry_timeout = timeouts["entry_timeout"]
+    return entry
+
+
+class AsyncOperations(pyfuse3.Operations):
+    """
+    Serves the requests with the operations of a FlumesFuse, by path. The
+    inodes are the ones of the paths, the paths are kept while the kernel
+    knows their inode
+    """
+
+    # Threads reading the media files
+    io_workers = 16
+    # Entries of a directory sent on every readdir
+    readdir_batch = 1000
+
+    def __init__(self, fs, timeouts):
+        super().__init__()
+        self.fs = fs
+        self.timeouts = timeouts
+        # Inode -> [path, lookup count]
+        self.inodes = {pyfuse3.ROOT_INODE: ["/", 1]}
+        # Handle -> (path, handle of the path)
+        self.handles = {}
+        self.next_fh = 1
+        self.sql = ThreadPoolExecutor(
+            max_workers=int(fs.pool_size), thread_name_prefix="sql"
+        )
+        self.io = ThreadPoolExecutor(
+            max_workers=self.io_workers, thread_name_prefix="io"
+        )
+
+    async def _run(self, executor, fn, *args):
+        ret = await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        # The fuse-python operations return the errors as negative numbers
+        if isinstance(ret, int) and ret < 0:
+            raise pyfuse3.FUSEError(-ret)
+        return ret
+
+    def _get_path(self, inode):
+        try:
+            return self.inodes[inode][0]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+    def _add_lookup(self, path, stat):
+        entry = self.inodes.setdefault(stat.st_ino, [path, 0])
+        entry[1] += 1
+        return to_entry_attributes(stat, self.timeouts)
+
+    def notify(self, path):
+        # Called from the thread watching the database
+        prefix = path.rstrip("/") + "/"
+        for inode, (p, _count) in list(self.inodes.items()):
+            if p == path or p.startswith(prefix):
+                try:
+                    pyfuse3.invalidate_inode(inode)
+                except OSError as e:
+                    logger.debug("Failed to invalidate %s: %s", p, e)
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        path = os.path.join(self._get_path(parent_inode), os.fsdecode(name))
+        try:
+            stat = await self._run(self.sql, self.fs.getattr, path)
+        except pyfuse3.FUSEError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # No inode, the kernel remembers the entry does not exist
+            entry = pyfuse3.EntryAttributes()
+            entry.st_ino = 0
+            entry.entry_timeout = self.timeouts["negative_timeout"]
+            return entry
+        return self._add_lookup(path, stat)
+
+    async def forget(self, inode_list):
+        for inode, nlookup in inode_list:
+            entry = self.inodes.get(inode)
+            if not entry or inode == pyfuse3.ROOT_INODE:
+                continue
+            entry[1] -= nlookup
+            if entry[1] <= 0:
+                del self.inodes[inode]
+
+    async def getattr(self, inode, ctx=None):
+        stat = await self._run(self.sql, self.fs.getattr, self._get_path(inode))
+        return to_entry_attributes(stat, self.timeouts)
+
+    async def readlink(self, inode, ctx):
+        target = await self._run(self.sql, self.fs.readlink, self._get_path(inode))
+        return os.fsencode(target)
+
+    async def opendir(self, inode, ctx):
+        self._get_path(inode)
+        return inode
+
+    def _list(self, path, start):
+        """
+        Next entries of a directory from start, with their attributes
+        """
+        entries = self.fs.readdir(path, start)
+        if isinstance(entries, int):
+            return entries
+        listed = []
+        try:
+            for i, entry in enumerate(entries):
+                # Tables resume the listing from the offset, others restart it
+                if not entry.offset and i < start:
+                    continue
+                if entry.name in [".", ".."]:
+                    continue
+                if len(listed) == self.readdir_batch:
+                    break
+                listed.append((entry, entry.offset or i + 1))
+        finally:
+            entries.close()
+        ret = []
+        for entry, next_id in listed:
+            # Entries that can not be stat'ed are not listed
+            child = os.path.join(path, entry.name)
+            stat = getattr(entry, "stat", None) or self.fs.getattr(child)
+            if isinstance(stat, int):
+                continue
+            ret.append((child, entry.name, stat, next_id))
+        return ret
+
+    async def readdir(self, fh, start_id, token):
+        path = self._get_path(fh)
+        entries = await self._run(self.sql, self._list, path, start_id)
+        for child, name, stat, next_id in entries:
+            attrs = to_entry_attributes(stat, self.timeouts)
+            if not pyfuse3.readdir_reply(token, os.fsencode(name), attrs, next_id):
+                break
+            # Every entry sent counts as a lookup
+            self._add_lookup(child, stat)
+
+    async def releasedir(self, fh):
+        pass
+
+    def _open(self, path, flags):
+        handle = self.fs.open(path, flags)
+        if isinstance(handle, int):
+            return handle
+        return handle, self.fs.keep_cache(path)
+
+    async def open(self, inode, flags, ctx):
+        path = self._get_path(inode)
+        handle, keep_cache = await self._run(self.sql, self._open, path, flags)
+        fh = self.next_fh
+        self.next_fh += 1
+        self.handles[fh] = (path, handle)
+        # Only the files invalidated when the database changes are kept,
+        # others like .stats or count would be served stale
+        return pyfuse3.FileInfo(
+            fh=fh,
+            direct_io=getattr(handle, "direct_io", False),
+            keep_cache=keep_cache,
+        )
+
+    async def read(self, fh, off, size):
+        path, handle = self.handles[fh]
+        if isinstance(handle, FileHandle):
+            return await self._run(self.io, handle.read, size, off)
+        return await self._run(self.sql, self.fs.read, path, size, off, handle)
+
+    async def release(self, fh):
+        _path, handle = self.handles.pop(fh)
+        if handle:
+            executor = self.io if isinstance(handle, FileHandle) else self.sql
+            await self._run(executor, handle.release)
+
+    def close(self):
+        self.sql.shutdown(wait=True)
+        self.io.shutdown(wait=True)
+
+
+def main(fs):
+    """
+    Mount with the options parsed by fs, a FlumesFuse
+    """
+    args = fs.fuse_args
+    timeouts = dict(kernel_cache_options)
+    options = set(pyfuse3.default_options)
+    options.add("fsname=flumes-fuse")
+    for name in args.optlist:
+        options.add(name)
+    for name, value in args.optdict.items():
+        if name in timeouts:
+            timeouts[name] = float(value)
+        else:
+            options.add("{}={}".format(name, value))
+    fs.fsinit()
+    operations = AsyncOperations(fs, timeouts)
+    fs.set_notifier(operations.notify)
+    pyfuse3.asyncio.enable()
+    pyfuse3.init(operations, args.mountpoint, options)
+    try:
+        asyncio.run(pyfuse3.main())
+    finally:
+        pyfuse3.close()
+        operations.close()
+        fs.fsdestroy()
@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded least recently used cache with hit/miss counters
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class PathCache(LRUCache):
+    """
+    Cache of resolved paths, keyed by the path string
+    """
+
+    def invalidate(self, path):
+        # Remove the path and everything below it
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            for p in [p for p in self.entries if p == path or p.startswith(prefix)]:
+                del self.entries[p]
+
+
+class ResultCache(LRUCache):
+    """
+    Cache of the sorted ids matching a search, keyed by its filters. The
+    least recently used searches are dropped once the ids use more memory
+    than allowed
+    """
+
+    # Bytes of every id
+    itemsize = 8
+
+    def __init__(self, memory):
+        super().__init__(memory)
+        self.used = 0
+        # Searches with more ids than allowed, not worth querying them again
+        self.oversized = LRUCache(1024)
+
+    def get_capacity(self):
+        """
+        Number of ids of a search that can be kept
+        """
+        return max(self.size, 0) // self.itemsize
+
+    def fits(self, key):
+        """
+        Whether the ids of the search could be kept
+        """
+        return self.size > 0 and key not in self.oversized
+
+    def put(self, key, ids):
+        size = ids.itemsize * len(ids)
+        if self.size <= 0:
+            return
+        if size > self.size:
+            self.oversized.put(key, True)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= old.itemsize * len(old)
+            self.entries[key] = ids
+            self.used += size
+            while self.used > self.size:
+                _key, evicted = self.entries.popitem(last=False)
+                self.used -= evicted.itemsize * len(evicted)
+
+    def invalidate(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= old.itemsize * len(old)
+        self.oversized.invalidate(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+        self.oversized.clear()
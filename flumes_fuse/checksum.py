@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.sql import and_, select
+
+logger = logging.getLogger(__name__)
+
+# Algorithms of the checksums, all of them are computed on the same read
+algorithms = ["sha256", "md5"]
+
+metadata = MetaData()
+
+# Checksums of the media files by their real path, valid while the size and
+# modification time are the same
+checksums_table = Table(
+    "checksums",
+    metadata,
+    Column("path", String, primary_key=True),
+    Column("size", Integer),
+    Column("mtime", String),
+    *[Column(a, String) for a in algorithms],
+)
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Hex digests of a file for every algorithm
+    """
+    hashes = [hashlib.new(a) for a in algorithms]
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            # The lock of the interpreter is released while hashing
+            for h in hashes:
+                h.update(data)
+    return {a: h.hexdigest() for a, h in zip(algorithms, hashes)}
+
+
+class Checksums(object):
+    """
+    Checksums of the media files, computed by a pool of threads reading the
+    files directly. When a sidecar database is given they are stored there,
+    keyed by the path, size and modification time of the file, and only
+    computed again once the file changes
+    """
+
+    # Bytes read on every step of the hashing
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path=None, workers=None):
+        self.engine = None
+        if path:
+            self.engine = create_engine("sqlite:///{}".format(path))
+            metadata.create_all(self.engine)
+        # Checksums of this mount when there is no sidecar database
+        self.digests = {}
+        # Checksums being computed, by path, size and modification time
+        self.pending = {}
+        self.computed = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or os.cpu_count(), thread_name_prefix="checksum"
+        )
+
+    def get(self, path, size, mtime, algorithm):
+        digests = self._load(path, size, mtime)
+        if digests is None:
+            digests = self._submit(path, size, mtime).result()
+        return digests[algorithm]
+
+    def prewarm(self, files):
+        """
+        Compute in parallel the checksums missing of the (path, size, mtime)
+        files, returns the number of files hashed
+        """
+        futures = []
+        for path, size, mtime in files:
+            if self._load(path, size, mtime) is None:
+                futures.append(self._submit(path, size, mtime))
+        done, _not_done = wait(futures)
+        failed = [f for f in done if f.exception()]
+        for f in failed:
+            logger.warning("Failed to compute a checksum: %s", f.exception())
+        return len(done) - len(failed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def _submit(self, path, size, mtime):
+        key = (path, size, str(mtime))
+        with self.lock:
+            future = self.pending.get(key)
+            if not future:
+                future = self.executor.submit(self._compute, key)
+                self.pending[key] = future
+        return future
+
+    def _compute(self, key):
+        try:
+            logger.debug("Computing the checksums of %s", key[0])
+            digests = hash_file(key[0], self.chunk_size)
+            self._store(key, digests)
+            with self.lock:
+                self.computed += 1
+            return digests
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _load(self, path, size, mtime):
+        key = (path, size, str(mtime))
+        if not self.engine:
+            with self.lock:
+                return self.digests.get(key)
+        t = checksums_table
+        stmt = select(*[t.c[a] for a in algorithms]).where(
+            and_(t.c.path == key[0], t.c.size == key[1], t.c.mtime == key[2])
+        )
+        with self.engine.connect() as conn:
+            row = conn.execute(stmt).first()
+        return dict(row._mapping) if row else None
+
+    def _store(self, key, digests):
+        if not self.engine:
+            with self.lock:
+                self.digests[key] = digests
+            return
+        values = dict(path=key[0], size=key[1], mtime=key[2], **digests)
+        stmt = insert(checksums_table).values(**values)
+        stmt = stmt.on_conflict_do_update(index_elements=["path"], set_=values)
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
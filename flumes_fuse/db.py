@@ -0,0 +1,177 @@
+import itertools
+import logging
+import sqlite3
+import threading
+
+from flumes.schema import Base, Meta, Schema
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+
+from .cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+
+class Database(Schema):
+    """
+    Flumes schema with an engine that can be shared among threads. Every thread
+    is expected to create its own session
+    """
+
+    def __init__(self, config, pool_size=8, results_memory=64 * 1024 * 1024):
+        super().__init__(config)
+        self.media_root = None
+        # Engine of the exports, they keep their connection while they are
+        # read and must not take the ones of the requests
+        self.export_engine = None
+        # Optional sidecar index of the searchable values
+        self.index = None
+        # Statistics of the operations, when collected
+        self.stats = None
+        # Value ranges of the searchable columns, by class and column
+        self.buckets = {}
+        # Ids of the files found by the searches
+        self.results = ResultCache(results_memory)
+        url = self.engine.url
+        if is_sqlite_file(url):
+            logger.debug("Creating engine for %s with %s connections", url, pool_size)
+            # Connections go back to the pool and are picked up by other threads
+            self.engine.dispose()
+            self.engine = create_engine(
+                url,
+                connect_args={"check_same_thread": False},
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                max_overflow=0,
+            )
+            event.listen(self.engine, "connect", _sqlite_connect)
+            self.export_engine = create_engine(
+                url, connect_args={"check_same_thread": False}, poolclass=NullPool
+            )
+            event.listen(self.export_engine, "connect", _sqlite_connect)
+        elif url.get_backend_name() != "sqlite":
+            self.engine.dispose()
+            self.engine = create_engine(url, pool_size=pool_size)
+            self.export_engine = create_engine(url, poolclass=NullPool)
+        else:
+            # Only the same engine sees an in-memory database
+            self.export_engine = self.engine
+        # Database the changes are watched on, the served one can be a copy
+        self.source_engine = self.engine
+        self.pool_size = pool_size
+        # Connection that keeps the in-memory copy alive
+        self.snapshot = None
+        # Increased every time the served database is replaced
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._create_sessionmaker()
+
+    def _create_sessionmaker(self):
+        # Objects are kept loaded between requests, we never write
+        self.sessionmaker = sessionmaker(
+            bind=self.engine, expire_on_commit=False, info={"database": self}
+        )
+
+    def load_snapshot(self, columns=()):
+        """
+        Copy the database into memory with indexes on the given columns and
+        serve it from there. Calling it again replaces the copy with a new
+        one once it is ready
+        """
+        if not is_sqlite_file(self.source_engine.url):
+            raise ValueError("Only SQLite files can be loaded into memory")
+        with self.lock:
+            uri = "file:flumes-fuse-{}?mode=memory&cache=shared".format(
+                next(_snapshot_ids)
+            )
+            snapshot = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            source = self.source_engine.raw_connection()
+            try:
+                source.connection.backup(snapshot)
+            finally:
+                source.close()
+            # The columns searched and the foreign keys the relationships use
+            columns = set(columns)
+            for table in Base.metadata.sorted_tables:
+                columns.update([fk.parent for fk in table.foreign_keys])
+            for c in sorted(columns, key=str):
+                snapshot.execute(
+                    "CREATE INDEX IF NOT EXISTS snapshot_{0}_{1} ON {0} ({1})".format(
+                        c.table.name, c.name
+                    )
+                )
+            snapshot.commit()
+            page_count = snapshot.execute("PRAGMA page_count").fetchone()[0]
+            page_size = snapshot.execute("PRAGMA page_size").fetchone()[0]
+            logger.info(
+                "Loaded %s into memory, %.1f MiB",
+                self.source_engine.url,
+                page_count * page_size / (1024 * 1024),
+            )
+
+            engine = create_engine(
+                "sqlite://",
+                creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+                poolclass=QueuePool,
+                pool_size=self.pool_size,
+                max_overflow=0,
+            )
+            event.listen(engine, "connect", _sqlite_connect)
+            export_engine = create_engine(
+                "sqlite://",
+                creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+                poolclass=NullPool,
+            )
+            event.listen(export_engine, "connect", _sqlite_connect)
+            # Sessions of the previous copy are replaced on their next use
+            previous = (self.engine, self.snapshot) if self.snapshot else None
+            self.engine = engine
+            self.export_engine = export_engine
+            self.snapshot = snapshot
+            self._create_sessionmaker()
+            self.generation += 1
+            if previous:
+                # The copy is gone once the sessions using it are closed
+                previous[0].dispose()
+                previous[1].close()
+
+
+# Names of the in-memory copies
+_snapshot_ids = itertools.count()
+
+
+def get_database(session):
+    """
+    Database the session was created from, if it was created by one
+    """
+    return session.info.get("database")
+
+
+def get_media_root(session):
+    """
+    Directory where the media files of the database are. It is only queried
+    once for sessions created by a Database
+    """
+    database = get_database(session)
+    if database and database.media_root is not None:
+        return database.media_root
+    root = session.query(Meta).one().root
+    if database:
+        database.media_root = root
+    return root
+
+
+def is_sqlite_file(url):
+    return url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
+    )
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # We are only readers, never take a write lock that blocks flumes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = 1")
+    cursor.close()
@@ -0,0 +1,246 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class FilePool(object):
+    """
+    Bounded pool of open file descriptors shared by every reader of a file.
+    When full, the least recently used descriptors not in use are closed
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        # Real path -> [fd, number of users]
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def acquire(self, path):
+        with self.lock:
+            f = self.files.get(path)
+            if f:
+                f[1] += 1
+                self.files.move_to_end(path)
+                return f[0]
+        # Do not block the other readers while opening
+        fd = os.open(path, os.O_RDONLY)
+        with self.lock:
+            f = self.files.get(path)
+            if f:
+                # Opened by another thread meanwhile
+                os.close(fd)
+                f[1] += 1
+                self.files.move_to_end(path)
+                return f[0]
+            logger.debug("Opened %s as %s", path, fd)
+            self.files[path] = [fd, 1]
+            self._evict()
+        return fd
+
+    def release(self, path):
+        with self.lock:
+            f = self.files.get(path)
+            if f:
+                f[1] -= 1
+                self._evict()
+
+    def close(self):
+        with self.lock:
+            for path, f in list(self.files.items()):
+                if not f[1]:
+                    os.close(f[0])
+                    del self.files[path]
+
+    def _evict(self):
+        if len(self.files) <= self.size:
+            return
+        for path, f in list(self.files.items()):
+            if len(self.files) <= self.size:
+                break
+            if f[1]:
+                continue
+            logger.debug("Closing %s", path)
+            os.close(f[0])
+            del self.files[path]
+
+
+class Prefetcher(object):
+    """
+    Shared state of the read ahead of every handle: the maximum window, the
+    memory all the read ahead buffers can use and the threads that fill them
+    """
+
+    # Size of the first window once a sequential read is detected
+    min_window = 128 * 1024
+
+    def __init__(self, window=4 * 1024 * 1024, memory=64 * 1024 * 1024, workers=4):
+        self.window = window
+        self.memory = memory
+        self.used = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="readahead"
+        )
+
+    def reserve(self, size):
+        with self.lock:
+            if self.used + size > self.memory:
+                return False
+            self.used += size
+            return True
+
+    def free(self, size):
+        with self.lock:
+            self.used -= size
+
+    def create(self, fd):
+        if not self.window or not self.memory:
+            return None
+        return ReadAhead(self, fd)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class Chunk(object):
+    def __init__(self, offset, size, future):
+        self.offset = offset
+        # Reserved memory, the data might be smaller at the end of file
+        self.size = size
+        self.future = future
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+class ReadAhead(object):
+    """
+    Detects the sequential reads on a descriptor and reads the next window
+    in the background while the current one is consumed. The window grows on
+    every sequential read, a seek goes back to direct reads
+    """
+
+    def __init__(self, prefetcher, fd):
+        self.prefetcher = prefetcher
+        self.fd = fd
+        self.window = min(prefetcher.min_window, prefetcher.window)
+        self.next_offset = 0
+        self.sequential = 0
+        self.chunks = []
+        # Reads dropped before being done, the descriptor is still in use
+        self.dropped = set()
+        self.lock = threading.Lock()
+
+    def read(self, size, offset):
+        with self.lock:
+            if offset != self.next_offset:
+                logger.debug("Seek from %s to %s", self.next_offset, offset)
+                self._reset()
+                data = os.pread(self.fd, size, offset)
+            else:
+                self.sequential += 1
+                data = self._read_buffered(size, offset)
+                if self.sequential > 1:
+                    self._prefetch(offset + len(data))
+            self.next_offset = offset + len(data)
+            return data
+
+    def close(self):
+        with self.lock:
+            self._reset()
+            # The descriptor can not be closed with a pending read on it
+            for future in list(self.dropped):
+                future.exception()
+
+    def _read_buffered(self, size, offset):
+        parts = []
+        while size and self.chunks:
+            chunk = self.chunks[0]
+            if offset < chunk.offset or offset >= chunk.end:
+                break
+            try:
+                data = chunk.future.result()
+            except OSError:
+                self._drop(self.chunks.pop(0))
+                break
+            part = data[offset - chunk.offset : offset - chunk.offset + size]
+            if part:
+                parts.append(part)
+                offset += len(part)
+                size -= len(part)
+            if offset >= chunk.offset + len(data):
+                # Consumed or end of file
+                self._drop(self.chunks.pop(0))
+                if len(data) < chunk.size:
+                    size = 0
+        if size:
+            parts.append(os.pread(self.fd, size, offset))
+        return b"".join(parts)
+
+    def _prefetch(self, offset):
+        # Two windows at most, the one being consumed and the next one
+        if len(self.chunks) > 1:
+            return
+        if self.chunks:
+            if self.chunks[0].end - offset > self.window // 2:
+                return
+            offset = self.chunks[0].end
+        size = self.window
+        if not self.prefetcher.reserve(size):
+            logger.debug("No memory left for reading ahead")
+            return
+        future = self.prefetcher.executor.submit(os.pread, self.fd, size, offset)
+        self.chunks.append(Chunk(offset, size, future))
+        self.window = min(self.window * 2, self.prefetcher.window)
+
+    def _drop(self, chunk):
+        def done(future):
+            self.dropped.discard(future)
+            self.prefetcher.free(chunk.size)
+
+        if chunk.future.cancel() or chunk.future.done():
+            self.prefetcher.free(chunk.size)
+        else:
+            self.dropped.add(chunk.future)
+            chunk.future.add_done_callback(done)
+
+    def _reset(self):
+        for chunk in self.chunks:
+            self._drop(chunk)
+        self.chunks = []
+        self.sequential = 0
+        self.window = min(self.prefetcher.min_window, self.prefetcher.window)
+
+
+class FileHandle(object):
+    """
+    Handle returned on open for files with a real file behind, reads are done
+    directly on the pooled descriptor
+    """
+
+    def __init__(self, pool, path, prefetcher=None):
+        self.pool = pool
+        self.path = path
+        self.fd = pool.acquire(path)
+        self.readahead = prefetcher.create(self.fd) if prefetcher else None
+
+    def read(self, size, offset):
+        if self.readahead:
+            return self.readahead.read(size, offset)
+        return os.pread(self.fd, size, offset)
+
+    def release(self):
+        if self.readahead:
+            self.readahead.close()
+            self.readahead = None
+        if self.fd is not None:
+            self.pool.release(self.path)
+            self.fd = None
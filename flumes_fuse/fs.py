@@ -1,108 +1,50 @@
-import argparse
 import errno
-import importlib
+import functools
 import logging
 import os
 import sys
-from datetime import datetime
-from errno import EACCES, ENOENT
-from stat import S_IFDIR, S_IFREG
+import threading
+from argparse import Namespace
+from stat import S_IFDIR
 from time import time
-from urllib.parse import urlparse
 
 import fuse
-from flumes.config import Config
 from flumes.options import Options
-from flumes.schema import (
-    Audio,
-    Field,
-    File,
-    Info,
-    Meta,
-    Schema,
-    Stream,
-    Subtitle,
-    Video,
-)
 from fuse import Fuse
-from sqlalchemy import create_engine
-from sqlalchemy.sql import select
-
-from .options import FlumesFuseOptions
-from .path import (
-    PathParser,
-    RootPath,
-    SearchPath,
-    SearchTablePath,
-    Stat,
-    TreeTablePath,
-    VirtualFile,
-)
+
+from .options import FlumesFuseOptions, kernel_cache_options, mount_options
+from .startup import StartupProfile
 
 logger = logging.getLogger(__name__)
 fuse.fuse_python_api = (0, 2)
 
 
-class FileContent(VirtualFile):
-    def _real_file(self, obj):
-        meta = self.session.query(Meta).one()
-        # Media dir + path + name
-        return os.path.join(meta.root, self.obj.path, self.obj.name)
-
-    def read(self, size, offset):
-        with open(self._real_file(self.obj), "rb") as f:
-            f.seek(offset)
-            content = f.read(size)
-            return content
-
-    def getattr(self):
-        ret = Stat()
-        ret.st_mode = S_IFREG | 0o444
-        ret.st_size = os.path.getsize(self._real_file(self.obj))
-        return ret
-
-
-class FilePath(TreeTablePath):
-    cls_name = File
-    extra_fields = [("contents", FileContent)]
-
-
-class SearchByStream(SearchTablePath):
-    cls_name = Stream
-
-
-class SearchBySubtitle(SearchTablePath):
-    cls_name = Subtitle
-
-
-class SearchByVideo(SearchTablePath):
-    cls_name = Video
-
-
-class SearchByAudio(SearchTablePath):
-    cls_name = Audio
-
-
-class SearchByField(SearchTablePath):
-    cls_name = Field
+def instrumented(op):
+    """
+    Collect the statistics of an operation, when enabled. Unexpected errors,
+    like running out of database connections, are logged and reported as EIO
+    """
 
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if not self._wait_ready(op):
+                return -errno.EIO
+            stats = self.schema.stats
+            if stats:
+                stats.start(op)
+            try:
+                return fn(self, *args, **kwargs)
+            except Exception:
+                logger.exception("Failed to %s %s", op, args[0] if args else "")
+                return -errno.EIO
+            finally:
+                if stats:
+                    stats.stop()
 
-class Search(SearchPath):
-    queries = [
-        ("stream", SearchByStream),
-        ("video", SearchByVideo),
-        ("audio", SearchByAudio),
-        ("subtitle", SearchBySubtitle),
-        ("field", SearchByField),
-    ]
-    results = FilePath
+        return wrapper
 
-    def get_join_stmt(self):
-        return select(File).join(File.info).join(Info.streams)
-
-
-class Root(RootPath):
-    cls_paths = [("files", FilePath), ("search", Search)]
+    return decorator
 
 
 class FlumesFuse(Fuse):
@@ -112,47 +54,451 @@ class FlumesFuse(Fuse):
         options = Options()
         for o in options._actions[1:]:
             setattr(self, o.dest, None)
+        for name, default, _help in mount_options:
+            setattr(self, name, default)
+        self.profile_startup = False
+        self.profile = StartupProfile()
+        self.profile_reported = False
+        self.notifier = None
 
     def fsinit(self):
-        # Initialize our own config
-        self.config = Config(self)
-        self.schema = Schema(self.config)
-        self.session = self.schema.create_session()
-        self.path_parser = PathParser(self.schema, Root)
+        self.stopped = threading.Event()
+        self.ready = threading.Event()
+        self.failed = False
+        self.watchers = []
+        # The mount is up meanwhile, the requests wait until it is ready
+        threading.Thread(target=self._setup, daemon=True).start()
         self.now = time()
 
+    def _setup(self):
+        try:
+            self._load()
+        except Exception:
+            logger.exception("Failed to set up the mount")
+            self.failed = True
+        finally:
+            self.ready.set()
+        if self.failed:
+            return
+        try:
+            self._warm()
+        except Exception:
+            logger.exception("Failed to warm up the mount")
+        self._report_startup()
+
+    def _get_shard_args(self):
+        """
+        Arguments of the config of every database served, the URIs of
+        several ones are separated by ;
+        """
+        if not self.uri or ";" not in self.uri:
+            return [self]
+        return [
+            Namespace(config=self.config, uri=uri) for uri in self.uri.split(";") if uri
+        ]
+
+    def _load(self):
+        """
+        Everything needed to serve the requests
+        """
+        profile = self.profile
+        with profile.measure("imports"):
+            # Imported here, the mount does not wait for them
+            from flumes.config import Config
+
+            from .db import Database, get_media_root
+            from .files import FilePool, Prefetcher
+            from .path import PathParser, TreeTablePath
+            from .registry import build_registry, parse_load_plan
+            from .stats import Stats
+            from .tree import ContentChecksum, FileContent, Root, Search
+
+        with profile.measure("database"):
+            # Initialize our own config, one per shard
+            configs = [Config(args) for args in self._get_shard_args()]
+            self.config = configs[0]
+            self.schemas = [
+                Database(
+                    config,
+                    pool_size=int(self.pool_size),
+                    results_memory=int(self.results_memory),
+                )
+                for config in configs
+            ]
+            self.schema = self.schemas[0]
+        if int(self.stats):
+            stats = Stats()
+            for schema in self.schemas:
+                schema.stats = stats
+            if float(self.stats_interval):
+                self._log_stats(float(self.stats_interval))
+        with profile.measure("registry"):
+            build_registry()
+        with profile.measure("media root"):
+            for schema in self.schemas:
+                session = schema.create_session()
+                try:
+                    get_media_root(session)
+                finally:
+                    session.close()
+        TreeTablePath.load_plan = parse_load_plan(self.load_plan)
+        Search.link_results = bool(int(self.link_results))
+        FileContent.pool = FilePool(int(self.file_pool_size))
+        FileContent.prefetcher = Prefetcher(
+            int(self.readahead_window), int(self.readahead_memory)
+        )
+        self.parsers = [
+            PathParser(
+                schema,
+                Root,
+                cache_size=int(self.cache_size),
+                max_objects=int(self.session_objects),
+            )
+            for schema in self.schemas
+        ]
+        self.path_parser = self.parsers[0]
+        if len(self.parsers) > 1:
+            from .union import UnionParser
+
+            self.path_parser = UnionParser(
+                self.parsers,
+                cache_size=int(self.cache_size),
+                workers=len(self.parsers) * int(self.pool_size),
+            )
+        if self.schema.stats:
+            self.schema.stats.add_gauge("memory", self.path_parser.get_sizes)
+        from .checksum import Checksums
+
+        ContentChecksum.checksums = Checksums(
+            self.checksum_cache, int(self.checksum_workers)
+        )
+
+    def _warm(self):
+        """
+        What can be done while the requests are served
+        """
+        profile = self.profile
+        if float(self.watch_interval):
+            from .watch import DatabaseWatcher
+
+            with profile.measure("watcher"):
+                for shard, schema in enumerate(self.schemas):
+                    watcher = DatabaseWatcher(schema, float(self.watch_interval))
+                    watcher.add_listener(
+                        functools.partial(self._database_changed, shard=shard)
+                    )
+                    watcher.start()
+                    self.watchers.append(watcher)
+        if int(self.snapshot):
+            from .tree import get_search_columns
+
+            # Served from the database until the copy replaces it
+            with profile.measure("snapshot"):
+                for schema in self.schemas:
+                    schema.load_snapshot(get_search_columns())
+        if self.index:
+            from .index import ValueIndex
+            from .tree import Search
+
+            for shard, schema in enumerate(self.schemas):
+                # Every shard has its own sidecar
+                path = self.index
+                if len(self.schemas) > 1:
+                    path = "{}.{}".format(self.index, shard)
+                schema.index = ValueIndex(
+                    path, [cls.cls_name for _name, cls in Search.queries]
+                )
+                self._refresh_index(shard)
+        if int(self.checksum_prewarm):
+            for schema in self.schemas:
+                self._prewarm_checksums(schema)
+
+    def _wait_ready(self, op):
+        if not self.ready.is_set():
+            logger.debug("Waiting for the mount to be ready to %s", op)
+            self.ready.wait()
+        if self.profile.add_op(op):
+            self._report_startup()
+        return not self.failed
+
+    def _report_startup(self):
+        # Once the mount is warm and the first operation served
+        if not self.profile_startup or not self.profile.first_op:
+            return
+        if not self.ready.is_set() or self.profile_reported:
+            return
+        self.profile_reported = True
+        print(self.profile.report(), file=sys.stderr)
+
+    def fsdestroy(self):
+        self.ready.wait()
+        for watcher in self.watchers:
+            watcher.stop()
+        self.stopped.set()
+        if self.failed:
+            return
+        if self.schema.stats:
+            self.schema.stats.close()
+        if self.path_parser not in self.parsers:
+            self.path_parser.close()
+        from .tree import ContentChecksum, FileContent
+
+        FileContent.prefetcher.shutdown()
+        FileContent.pool.close()
+        ContentChecksum.checksums.shutdown()
+
+    def _database_changed(self, changes, shard=0):
+        from flumes.schema import File, Meta
+
+        schema = self.schemas[shard]
+        parser = self.parsers[shard]
+        if schema.snapshot:
+            from .tree import get_search_columns
+
+            # Serve the changes from a new copy, the sessions are replaced
+            schema.load_snapshot(get_search_columns())
+        paths = set()
+        objects = []
+        for change in changes:
+            if change.cls == Meta:
+                schema.media_root = None
+            elif change.rows is None:
+                # Rows were updated or deleted, start from scratch
+                logger.info("Table %s changed", change.cls.__tablename__)
+                parser.invalidate()
+                paths.add("/files")
+            elif change.cls == File:
+                # The new files are only new entries of the table directory
+                paths.add("/files")
+            else:
+                for row in change.rows:
+                    objects.extend([(cls, pk) for cls, pk in row if pk is not None])
+                    paths.update(
+                        ["/files/{}".format(pk) for cls, pk in row if cls == File]
+                    )
+        for path in paths:
+            parser.invalidate(path)
+        if objects:
+            parser.invalidate(objects=objects)
+        # Any change might modify the results of the searches
+        if [c for c in changes if c.cls != Meta]:
+            schema.results.clear()
+            schema.buckets.clear()
+            parser.invalidate("/search")
+            paths.add("/search")
+            if schema.index:
+                # The rows updated or deleted are only dropped by indexing
+                # their tables again
+                changed = [c.cls.__table__ for c in changes if c.rows is None]
+                self._refresh_index(shard, changed)
+        if parser is not self.path_parser:
+            # The union has paths of its own for the ones of the shard
+            paths = set([self.path_parser.get_path(shard, p) for p in paths])
+            for path in paths:
+                self.path_parser.invalidate(path)
+        for path in sorted(paths):
+            self._notify(path)
+
+    def set_notifier(self, notifier):
+        """
+        Tell the kernel to forget the changed paths with notifier(path), for
+        the backends other than fuse-python
+        """
+        self.notifier = notifier
+
+    def _notify(self, path):
+        # Not every binding can tell the kernel to forget a path, in that case
+        # it will be asked again once attr_timeout and entry_timeout expire
+        invalidate = self.notifier or getattr(self, "Invalidate", None)
+        if not invalidate:
+            return
+        try:
+            invalidate(path)
+        except Exception as e:
+            logger.debug("Failed to invalidate %s: %s", path, e)
+
+    def _log_stats(self, interval):
+        def log():
+            while not self.stopped.wait(interval):
+                logger.info("Stats: %s", self.schema.stats.summary())
+
+        threading.Thread(target=log, daemon=True).start()
+
+    def _parse(self, path):
+        p = self.path_parser.parse(path)
+        if self.schema.stats:
+            self.schema.stats.set_path(p)
+        return p
+
+    def _refresh_index(self, shard=0, changed=()):
+        schema = self.schemas[shard]
+
+        def refresh():
+            schema.index.refresh(schema, changed)
+            # The searches resolved meanwhile might be outdated
+            schema.results.clear()
+            self.parsers[shard].invalidate("/search")
+            self.path_parser.invalidate("/search")
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _prewarm_checksums(self, schema):
+        from flumes.schema import File
+        from sqlalchemy.sql import select
+
+        from .db import get_media_root
+        from .tree import ContentChecksum
+
+        def files(session):
+            media_root = get_media_root(session)
+            stmt = select(File.path, File.name, File.mtime).order_by(File.id)
+            for path, name, mtime in session.execute(stmt):
+                path = os.path.join(media_root, path, name)
+                try:
+                    yield path, os.path.getsize(path), mtime
+                except OSError as e:
+                    logger.debug("Can not compute the checksums of %s: %s", path, e)
+
+        def prewarm():
+            session = schema.create_session()
+            try:
+                n = ContentChecksum.checksums.prewarm(files(session))
+            finally:
+                session.close()
+            logger.info("Computed the checksums of %s files", n)
+
+        threading.Thread(target=prewarm, daemon=True).start()
+
+    def _readdir(self, path, p, offset):
+        # The entries are consumed once we have returned
+        entries = []
+        try:
+            for entry in p.readdir(offset):
+                if getattr(entry, "stat", None):
+                    entries.append(entry)
+                yield entry
+            # The getattr calls that usually follow are served from the listing
+            if not offset:
+                self.path_parser.put_attrs(path, entries)
+        finally:
+            self.path_parser.release()
+            if self.schema.stats:
+                self.schema.stats.stop()
+
+    @instrumented("open")
     def open(self, path, flags):
         try:
-            self.path_parser.parse(path)
-            return self.path_parser.open(flags)
+            p = self._parse(path)
+            return p.open(flags)
         except FileNotFoundError:
             return -errno.ENOENT
-
-    def read(self, path, size, offset):
+        except OSError as e:
+            return -e.errno
+        finally:
+            self.path_parser.release()
+
+    def keep_cache(self, path):
+        """
+        Whether the kernel can keep the content of a file once it is closed
+        """
         try:
-            p = self.path_parser.parse(path)
-            return self.path_parser.read(size, offset)
+            return self._parse(path).get_leaf().keep_cache
+        except FileNotFoundError:
+            return False
+        finally:
+            self.path_parser.release()
+
+    @instrumented("read")
+    def read(self, path, size, offset, fh=None):
+        # Files with a handle are read directly from it
+        if fh:
+            return fh.read(size, offset)
+        try:
+            p = self._parse(path)
+            return p.read(size, offset)
         except FileNotFoundError:
             return -errno.ENOENT
+        finally:
+            self.path_parser.release()
+
+    @instrumented("release")
+    def release(self, path, flags, fh=None):
+        if fh:
+            fh.release()
+        return 0
 
     def readdir(self, path, offset):
+        if not self._wait_ready("readdir"):
+            return -errno.EIO
+        # The statistics are collected until the entries are consumed
+        if self.schema.stats:
+            self.schema.stats.start("readdir")
+        try:
+            p = self._parse(path)
+        except FileNotFoundError:
+            self.path_parser.release()
+            if self.schema.stats:
+                self.schema.stats.stop()
+            return -errno.ENOENT
+        return self._readdir(path, p, offset)
+
+    @instrumented("readlink")
+    def readlink(self, path):
         try:
-            p = self.path_parser.parse(path)
-            return self.path_parser.readdir(offset)
+            p = self._parse(path)
+            return p.readlink()
         except FileNotFoundError:
             return -errno.ENOENT
+        except OSError as e:
+            return -e.errno
+        finally:
+            self.path_parser.release()
 
     def getattr(self, path):
+        # The root is known before the mount is ready
+        if path == "/" and not self.ready.is_set():
+            self.profile.add_op("getattr")
+            return fuse.Stat(
+                st_mode=S_IFDIR | 0o755,
+                st_ino=1,
+                st_dev=0,
+                st_nlink=2,
+                st_uid=0,
+                st_gid=0,
+                st_size=0,
+                st_atime=0,
+                st_mtime=0,
+                st_ctime=0,
+            )
+        return self._getattr(path)
+
+    @instrumented("getattr")
+    def _getattr(self, path):
+        attr = self.path_parser.get_attr(path)
+        if attr:
+            return attr
         try:
-            p = self.path_parser.parse(path)
-            return self.path_parser.getattr()
+            p = self._parse(path)
+            return p.getattr()
         except FileNotFoundError:
             return -errno.ENOENT
+        finally:
+            self.path_parser.release()
 
 
 def run():
-    # SQlite driver "can not work" in a multithread environment
-    # Make the option always available
+    # Requests are served from several threads unless -s is passed
     fuse = FlumesFuse(parser_class=FlumesFuseOptions, dash_s_do="setsingle")
     args = fuse.parse(values=fuse)
+    if fuse.backend == "pyfuse3":
+        # Only this backend needs pyfuse3, it is optional
+        from .aio import main
+
+        main(fuse)
+        return
+    # Let the kernel cache what we serve unless told otherwise, with our inodes
+    for name, default in kernel_cache_options:
+        if name not in fuse.fuse_args.optdict:
+            fuse.fuse_args.add(name, str(default))
+    fuse.fuse_args.add("use_ino")
     fuse.main()
@@ -0,0 +1,222 @@
+import logging
+import threading
+from collections import Counter
+
+from flumes.schema import File, Info, Stream
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, inspect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.sql import and_, intersect, select
+
+from .path import to_path_name
+from .registry import get_class_info, get_join_path
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# Distinct values of every column, by their path name, and number of rows
+values_table = Table(
+    "index_values",
+    metadata,
+    Column("cls", String, primary_key=True),
+    Column("column", String, primary_key=True),
+    Column("name", String, primary_key=True),
+    Column("count", Integer),
+)
+
+# Rows every value is on and the files they belong to
+postings_table = Table(
+    "index_postings",
+    metadata,
+    Column("cls", String, primary_key=True),
+    Column("column", String, primary_key=True),
+    Column("name", String, primary_key=True),
+    Column("file_id", Integer, primary_key=True),
+    Column("row_id", Integer, primary_key=True),
+)
+
+# Last primary key indexed of every class
+state_table = Table(
+    "index_state",
+    metadata,
+    Column("cls", String, primary_key=True),
+    Column("last_id", Integer),
+)
+
+
+class ValueIndex(object):
+    """
+    Sidecar database with the distinct values of the searchable columns, the
+    number of rows with each value and the rows and files they belong to.
+    Only rows added since the last refresh are indexed, the classes whose
+    rows were updated or deleted are indexed again
+    """
+
+    # Number of rows read from the database on every query
+    batch_size = 10000
+    # Classes with a row per file, the others are the streams searched
+    file_classes = [File, Info]
+
+    def __init__(self, path, classes):
+        self.engine = create_engine("sqlite:///{}".format(path))
+        columns = inspect(self.engine).get_columns(postings_table.name)
+        if columns and "row_id" not in [c["name"] for c in columns]:
+            # Index of a previous version, it is built again
+            metadata.drop_all(self.engine)
+        metadata.create_all(self.engine)
+        self.classes = classes
+        # An index of a previous mount can be used until it is refreshed
+        self.ready = all([self._get_last_id(cls) is not None for cls in classes])
+        self.lock = threading.Lock()
+
+    def has_column(self, cls, column):
+        return cls in self.classes and column in get_class_info(cls).columns
+
+    def has_value(self, cls, column, name):
+        stmt = select(values_table.c.count).where(
+            and_(
+                values_table.c.cls == cls.__name__,
+                values_table.c.column == column,
+                values_table.c.name == name,
+            )
+        )
+        with self.engine.connect() as conn:
+            return conn.execute(stmt).scalar() is not None
+
+    def get_values(self, cls, column):
+        """
+        Path names of the values of a column and their number of rows
+        """
+        stmt = (
+            select(values_table.c.name, values_table.c.count)
+            .where(
+                and_(
+                    values_table.c.cls == cls.__name__,
+                    values_table.c.column == column,
+                )
+            )
+            .order_by(values_table.c.name)
+        )
+        with self.engine.connect() as conn:
+            return conn.execute(stmt).all()
+
+    def _get_postings(self, cls, column, name, *columns):
+        return select(*columns).where(
+            and_(
+                postings_table.c.cls == cls.__name__,
+                postings_table.c.column == column,
+                postings_table.c.name == name,
+            )
+        )
+
+    def get_files(self, filters):
+        """
+        Ids of the files matching every (class, column, path name) filter, as
+        the search does: the filters on the streams must match the same
+        stream. None when the index can not tell, like searches without
+        filters on the streams, which only match files with streams
+        """
+        c = postings_table.c
+        streams = [f for f in filters if issubclass(f[0], Stream)]
+        files = [f for f in filters if f[0] in self.file_classes]
+        if not streams or len(streams) + len(files) != len(filters):
+            return None
+        stmts = [self._get_postings(*f, c.file_id, c.row_id) for f in streams]
+        rows = intersect(*stmts) if len(stmts) > 1 else stmts[0]
+        rows = rows.subquery()
+        stmts = [select(rows.c.file_id)]
+        stmts.extend([self._get_postings(*f, c.file_id) for f in files])
+        stmt = intersect(*stmts) if len(stmts) > 1 else stmts[0].distinct()
+        with self.engine.connect() as conn:
+            return sorted(conn.execute(stmt).scalars().all())
+
+    def refresh(self, schema, changed=()):
+        """
+        Index the rows added to the database since the last refresh, and all
+        the rows of the classes whose table is in changed
+        """
+        with self.lock:
+            session = schema.create_session()
+            try:
+                for cls in self.classes:
+                    if cls.__table__ in changed:
+                        self._reset_class(cls)
+                    self._refresh_class(session, cls)
+            finally:
+                session.close()
+            self.ready = True
+
+    def _get_last_id(self, cls):
+        stmt = select(state_table.c.last_id).where(state_table.c.cls == cls.__name__)
+        with self.engine.connect() as conn:
+            return conn.execute(stmt).scalar()
+
+    def _refresh_class(self, session, cls):
+        info = get_class_info(cls)
+        pk = getattr(cls, info.pk)
+        stmt = select(pk, File.id, *[getattr(cls, c) for c in info.columns])
+        stmt = stmt.select_from(cls)
+        for r in get_join_path(cls, File):
+            stmt = stmt.join(r, isouter=True)
+        stmt = stmt.order_by(pk).limit(self.batch_size)
+
+        last = self._get_last_id(cls)
+        indexed = 0
+        while True:
+            batch_stmt = stmt if last is None else stmt.where(pk > last)
+            rows = session.execute(batch_stmt).all()
+            if not rows:
+                break
+            counts = Counter()
+            postings = set()
+            for row in rows:
+                for column, value in zip(info.columns, row[2:]):
+                    if value is None:
+                        continue
+                    name = to_path_name(value)
+                    counts[(column, name)] += 1
+                    if row[1] is not None:
+                        postings.add((column, name, row[1], row[0]))
+            last = rows[-1][0]
+            self._store(cls, counts, postings, last)
+            indexed += len(rows)
+        logger.info("Indexed %s new rows of %s", indexed, cls.__name__)
+
+    def _reset_class(self, cls):
+        logger.info("Indexing again the rows of %s", cls.__name__)
+        # Not used until it is indexed again
+        self.ready = False
+        name = cls.__name__
+        with self.engine.begin() as conn:
+            for table in [values_table, postings_table, state_table]:
+                conn.execute(table.delete().where(table.c.cls == name))
+
+    def _store(self, cls, counts, postings, last):
+        name = cls.__name__
+        with self.engine.begin() as conn:
+            if counts:
+                stmt = insert(values_table)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["cls", "column", "name"],
+                    set_={"count": values_table.c.count + stmt.excluded.count},
+                )
+                conn.execute(
+                    stmt,
+                    [
+                        {"cls": name, "column": c, "name": n, "count": count}
+                        for (c, n), count in counts.items()
+                    ],
+                )
+            if postings:
+                conn.execute(
+                    postings_table.insert().prefix_with("OR IGNORE"),
+                    [
+                        {"cls": name, "column": c, "name": n, "file_id": f, "row_id": r}
+                        for c, n, f, r in postings
+                    ],
+                )
+            stmt = insert(state_table).values(cls=name, last_id=last)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["cls"], set_={"last_id": last}
+            )
+            conn.execute(stmt)
@@ -1,6 +1,40 @@
 from flumes.options import Options
 from fuse import FuseOptParse
 
+# Mount options of flumes-fuse on top of the flumes ones: name, default, help
+mount_options = [
+    ("backend", "fuse", "fuse, or pyfuse3 to serve many requests at once"),
+    ("cache_size", 4096, "number of resolved paths to keep in memory per thread"),
+    ("session_objects", 20000, "objects to keep loaded per thread, 0 for any"),
+    ("pool_size", 8, "number of database connections shared by the threads"),
+    ("file_pool_size", 64, "number of media files to keep open"),
+    ("readahead_window", 4 * 1024 * 1024, "maximum bytes to read ahead, 0 disables"),
+    ("readahead_memory", 64 * 1024 * 1024, "bytes all the read ahead buffers can use"),
+    ("results_memory", 64 * 1024 * 1024, "bytes the ids of the searches can use"),
+    ("link_results", 0, "serve the results of the searches as links to /files"),
+    ("snapshot", 0, "serve a copy of the database loaded into memory"),
+    ("watch_interval", 1, "seconds between checks for database changes, 0 disables"),
+    ("stats", 0, "collect statistics of the operations, readable at /.stats"),
+    ("stats_interval", 0, "seconds between logging the statistics, 0 disables"),
+    (
+        "load_plan",
+        "File.info:joined",
+        "how to load the relationships, as <class>.<relationship>:<strategy>;...",
+    ),
+    ("index", None, "sidecar database to index the searchable values in"),
+    ("checksum_cache", None, "sidecar database to keep the checksums in"),
+    ("checksum_workers", 0, "threads computing checksums, 0 for one per core"),
+    ("checksum_prewarm", 0, "compute the checksums of every file when mounting"),
+]
+
+# Options handled by libfuse on how long the kernel caches attributes, lookups
+# and failed lookups: name, default in seconds
+kernel_cache_options = [
+    ("attr_timeout", 30),
+    ("entry_timeout", 30),
+    ("negative_timeout", 5),
+]
+
 
 class FlumesFuseOptions(FuseOptParse):
     def __init__(self, *args, **kwargs):
@@ -8,3 +42,13 @@ class FlumesFuseOptions(FuseOptParse):
         options = Options()
         for o in options._actions[1:]:
             self.add_option(mountopt=o.dest, action="store", help=o.help)
+        for name, default, help in mount_options:
+            if default is not None:
+                help = "{} (default: {})".format(help, default)
+            self.add_option(mountopt=name, action="store", help=help)
+        self.add_option(
+            "--profile-startup",
+            action="store_true",
+            dest="profile_startup",
+            help="print the time spent on every step of the mount",
+        )
@@ -1,13 +1,33 @@
+import csv
+import errno
+import hashlib
+import io
+import json
 import logging
 import os
-from stat import S_IFDIR, S_IFREG
+import threading
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from itertools import islice
+from stat import S_IFDIR, S_IFLNK, S_IFREG
 
 import fuse
 from flumes.schema import Base, File, Info
+from sqlalchemy import distinct, func, inspect
+from sqlalchemy.orm import MANYTOONE, ONETOMANY
+from sqlalchemy.orm.base import NO_VALUE
 from sqlalchemy.orm.collections import InstrumentedList
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import select
+
+from .cache import PathCache
+from .db import get_database
+from .ranges import get_buckets, get_kind, parse_range
+from .registry import get_class_info, get_load_options
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
 
 class VirtualFile(object):
@@ -15,6 +35,10 @@ class VirtualFile(object):
         self.session = session
         self.obj = obj
 
+    def open(self, flags):
+        # Return a handle to have the reads sent to it
+        return None
+
     def read(self, size, offset):
         raise NotImplementedError
 
@@ -36,12 +60,144 @@ class Stat(fuse.Stat):
         self.st_ctime = 0
 
 
+def get_inode(key):
+    """
+    Stable inode number for the tuple that identifies a path, the root being 1
+    """
+    if not key:
+        return 1
+    digest = hashlib.blake2b("/".join([str(k) for k in key]).encode(), digest_size=8)
+    ino = int.from_bytes(digest.digest(), "little") & 0x7FFFFFFFFFFFFFFF
+    # Skip the values reserved for no inode and the root
+    return ino if ino > 1 else ino + 2
+
+
+def get_timestamp(obj):
+    """
+    Modification time of an object or the object it belongs to, flumes
+    stores it in UTC
+    """
+    mtime = getattr(obj, "mtime", None)
+    if isinstance(mtime, datetime):
+        return mtime.replace(tzinfo=timezone.utc).timestamp()
+    return 0
+
+
+def to_export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value if isinstance(value, (int, float, str)) else str(value)
+
+
+def to_path_name(value):
+    # Make the value "pathable", change / by _-_
+    return str(value).replace(os.path.sep, "_-_")
+
+
 class NullField(object):
     def __str__(self):
         return ""
 
 
+class RecordFile(VirtualFile):
+    """
+    JSON document with the columns of an object and the objects that belong
+    to it, loaded at once. The encoded document is kept for the next reads
+    """
+
+    def __init__(self, session, obj):
+        super().__init__(session, obj)
+        self.data = None
+
+    def _get_data(self):
+        if self.data is None:
+            obj = self.obj
+            if not self._is_loaded(obj, set()):
+                obj = self._load()
+            record = self._get_record(obj, set())
+            self.data = json.dumps(record, indent=2).encode() + b"\n"
+        return self.data
+
+    def _is_loaded(self, obj, visited):
+        # Whether everything below the object is in the session already, like
+        # after the record of the object it belongs to
+        visited.add(obj)
+        unloaded = inspect(obj).unloaded
+        for r in get_class_info(type(obj)).relationships.values():
+            if r.direction is not ONETOMANY:
+                continue
+            if r.key in unloaded:
+                return False
+            value = getattr(obj, r.key)
+            values = value if r.uselist else [value]
+            for o in values:
+                if o is not None and o not in visited:
+                    if not self._is_loaded(o, visited):
+                        return False
+        return True
+
+    def _load(self):
+        cls = type(self.obj)
+        info = get_class_info(cls)
+        # Load everything below the object with one query per relationship
+        plan = {}
+        pending = [cls]
+        while pending:
+            c = pending.pop()
+            if c in plan:
+                continue
+            children = [
+                r
+                for r in get_class_info(c).relationships.values()
+                if r.direction is ONETOMANY
+            ]
+            plan[c] = [(r.key, "selectin") for r in children]
+            pending.extend([r.target for r in children])
+        stmt = (
+            select(cls)
+            .where(getattr(cls, info.pk) == getattr(self.obj, info.pk))
+            .options(*get_load_options(cls, plan))
+            .execution_options(populate_existing=True)
+        )
+        return self.session.execute(stmt).scalars().one()
+
+    def _get_record(self, obj, visited):
+        visited.add(obj)
+        info = get_class_info(type(obj))
+        record = {}
+        for c in info.all_columns:
+            value = getattr(obj, c)
+            record[c] = value.isoformat() if isinstance(value, datetime) else value
+        for r in info.relationships.values():
+            if r.direction is not ONETOMANY:
+                continue
+            value = getattr(obj, r.key)
+            if r.uselist:
+                record[r.key] = [
+                    self._get_record(o, visited) for o in value if o not in visited
+                ]
+            elif value is not None and value not in visited:
+                record[r.key] = self._get_record(value, visited)
+            else:
+                record[r.key] = None
+        return record
+
+    def read(self, size, offset):
+        return self._get_data()[offset : offset + size]
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        ret.st_size = len(self._get_data())
+        return ret
+
+
 class Path(object):
+    # Whether the kernel can keep the content read once the file is closed,
+    # only for the paths that are invalidated when the database changes
+    keep_cache = False
+
     def __init__(self, session):
         self.session = session
 
@@ -60,6 +216,21 @@ class Path(object):
     def getattr(self):
         raise NotImplementedError
 
+    def readlink(self):
+        raise OSError(errno.EINVAL, "Not a link")
+
+    def key(self):
+        """
+        Tuple that identifies the path, used to generate its inode
+        """
+        return ()
+
+    def get_leaf(self):
+        """
+        Path that resolved the last component of the path
+        """
+        return self
+
 
 class TablePath(Path):
     """
@@ -75,13 +246,10 @@ class TablePath(Path):
             cls_name = type(obj)
         else:
             cls_name = self.cls_name
-        ret = []
-        for field in [f for f in cls_name.__table__.columns]:
-            if not with_primary_key and field.primary_key:
-                continue
-            if hasattr(cls_name, field.name):
-                ret.append(field.name)
-        return ret
+        info = get_class_info(cls_name)
+        if with_primary_key:
+            return info.all_columns
+        return info.columns
 
 
 class TreeTablePath(TablePath):
@@ -90,6 +258,17 @@ class TreeTablePath(TablePath):
     /<table>/<id>/<field>
     """
 
+    # Number of primary keys fetched on every query when listing the table
+    batch_size = 1000
+    # How to load the relationships of the objects, see parse_load_plan
+    load_plan = {}
+    # Virtual files of the objects at the root: name, VirtualFile class
+    extra_fields = []
+    # Virtual files of every object: name, VirtualFile class
+    object_fields = []
+    # The paths of the objects are invalidated when they change
+    keep_cache = True
+
     def __init__(self, session, **kwargs):
         super().__init__(session)
         self.table = None
@@ -97,87 +276,104 @@ class TreeTablePath(TablePath):
         self.field = None
         self.fields = []
         self.obj = None
+        # Encoded value of a scalar field
+        self.data = None
         # In case the field is another class relationship list, keep the primary key
         # Get the name of the primary key field
-        self.pk = [f.name for f in self.cls_name.__table__.columns if f.primary_key][0]
+        self.pk = get_class_info(self.cls_name).pk
         self.filtered_stmt = None
+        # Sorted primary keys of the filtered objects, when known beforehand
+        self.ids = None
         if kwargs:
             self.filtered_stmt = kwargs.get("filtered")
+            self.ids = kwargs.get("ids")
 
     def _get_relationships(self, obj):
         cls_name = type(obj)
         ret = []
-        for relationship in [r for r in cls_name.__mapper__.relationships]:
+        for relationship in get_class_info(cls_name).relationships.values():
             r = relationship.key
-            logger.debug("Relationship {}".format(r))
-            if hasattr(cls_name, r):
-                # Avoid a relationship that we have traversed already
-                # We won't move to the class this Path points to
-                if relationship.mapper.class_ == self.cls_name:
-                    logger.debug("Avoid pointing to '{}' again".format(cls_name))
-                    continue
-                # We don't want to traverse again the same object as before
-                # FIXME Check the path, assuming the there are no columns with the same name
-                if r in self.field_path:
-                    logger.debug(
-                        "Relationship already traversed {} {}".format(
-                            r, self.field_path
-                        )
-                    )
-                    continue
-                # Check the actual object
-                field = getattr(obj, r, None)
-                if field in self.fields:
-                    logger.debug(
-                        "Relationship already traversed {} {}".format(
-                            r, self.field_path
-                        )
-                    )
-                    continue
-                ret.append(r)
+            logger.debug("Relationship %s", r)
+            # Avoid a relationship that we have traversed already
+            # We won't move to the class this Path points to
+            if relationship.target == self.cls_name:
+                logger.debug("Avoid pointing to '%s' again", cls_name)
+                continue
+            # We don't want to traverse again the same object as before
+            # FIXME Check the path, assuming the there are no columns with the same name
+            if r in self.field_path:
+                logger.debug("Relationship already traversed %s %s", r, self.field_path)
+                continue
+            # Check the actual object
+            if self._is_traversed(obj, r):
+                logger.debug("Relationship already traversed %s %s", r, self.field_path)
+                continue
+            ret.append(r)
         return ret
 
+    def _is_traversed(self, obj, r):
+        # Avoid loading the relationship just to check it
+        state = inspect(obj)
+        field = state.attrs[r].loaded_value
+        if field is not NO_VALUE:
+            return field in self.fields
+        relationship = state.mapper.relationships[r]
+        if relationship.direction is not MANYTOONE:
+            # A collection we went through would be loaded
+            return False
+        # The object it points to is known by the foreign key
+        columns = dict(
+            [(remote, local) for local, remote in relationship.local_remote_pairs]
+        )
+        pk = [
+            state.mapper.get_property_by_column(columns[c]).key
+            for c in relationship.mapper.primary_key
+        ]
+        key = identity_key(
+            relationship.mapper.class_, tuple([getattr(obj, k) for k in pk])
+        )
+        return key in [
+            inspect(f).identity_key for f in self.fields if isinstance(f, Base)
+        ]
+
     def _get_field(self, attr):
         obj = self.obj
         field = None
         prev_obj = None
         prev_attr = None
-        logger.debug("Getting fields {}".format(attr))
+        logger.debug("Getting fields %s", attr)
         while attr:
             a = attr[0]
             field = None
-            logger.debug("Getting field {}".format(a))
+            logger.debug("Getting field %s", a)
             # Handle the primary key case of an InstrumentedList
             if isinstance(obj, InstrumentedList):
-                logger.debug(
-                    "Handling InstrumentedList in {} for {}".format(prev_obj, obj)
+                logger.debug("Handling InstrumentedList in %s for %s", prev_obj, obj)
+                # The list is already loaded, look the primary key up in it
+                for item in obj:
+                    if str(getattr(item, get_class_info(type(item)).pk)) == a:
+                        field = item
+                        break
+            elif isinstance(obj, Base) and a in [vf[0] for vf in self.object_fields]:
+                logger.debug("Handling object field %s", a)
+                field = [vf[1] for vf in self.object_fields if vf[0] == a][0](
+                    self.session, obj
                 )
-                # Get the relationship that matches
-                r = [
-                    r
-                    for r in prev_obj.__class__.__mapper__.relationships
-                    if r.key == prev_attr
-                ][0]
-                r_class = r.mapper.class_
-                pk = [f.name for f in r_class.__table__.columns if f.primary_key][0]
-                stmt = self.session.query(r_class).filter(getattr(r_class, pk) == a)
-                result = self.session.execute(stmt)
-                field = result.scalar()
             elif a in [vf[0] for vf in self.extra_fields]:
-                logger.debug("Handling extra field {}".format(a))
+                logger.debug("Handling extra field %s", a)
                 field = [vf[1] for vf in self.extra_fields if vf[0] == a][0](
                     self.session, self.obj
                 )
             else:
-                logger.debug("Handling basic field {} for {}".format(a, obj))
+                logger.debug("Handling basic field %s for %s", a, obj)
                 if a in self._get_columns(obj) or a in self._get_relationships(obj):
                     field = getattr(obj, a, None)
                     if not field:
-                        logger.debug("Null field {} in {}".format(a, obj))
+                        logger.debug("Null field %s in %s", a, obj)
                         field = NullField()
 
             if not field:
-                logger.debug("Field {} not found in {}".format(a, obj))
+                logger.debug("Field %s not found in %s", a, obj)
                 break
 
             self.fields.append(field)
@@ -190,24 +386,57 @@ class TreeTablePath(TablePath):
 
         return field
 
+    def _get_entry(self, name, value=NO_VALUE):
+        """
+        Entry of a field with the attributes getattr would return, when its
+        value is already loaded
+        """
+        entry = fuse.Direntry(name)
+        if value is NO_VALUE:
+            return entry
+        if not value:
+            value = NullField()
+        ret = Stat()
+        if isinstance(value, Base) or isinstance(value, list):
+            ret.st_mode = S_IFDIR | 0o755
+            ret.st_nlink = 2
+        else:
+            ret.st_mode = S_IFREG | 0o444
+            ret.st_nlink = 1
+            ret.st_size = len(str(value).encode("UTF-8"))
+        mtime = get_timestamp(self.obj)
+        ret.st_mtime = ret.st_ctime = ret.st_atime = mtime
+        entry.type = ret.st_mode >> 12
+        entry.stat = ret
+        return entry
+
+    def _get_virtual_entries(self, fields):
+        # Files, the attributes might be expensive to get
+        for name, _cls in fields:
+            entry = fuse.Direntry(name)
+            entry.type = S_IFREG >> 12
+            yield entry
+
     def _get_obj_contents(self, obj):
         cls_name = type(obj)
-        logger.debug("Class name {}".format(cls_name))
+        logger.debug("Class name %s", cls_name)
         # First the fields
         for field in self._get_columns(obj):
-            yield fuse.Direntry(field)
-        # Now the relationships
+            yield self._get_entry(field, getattr(obj, field, None))
+        # Now the relationships, without loading them
+        state = inspect(obj)
         for relationship in self._get_relationships(obj):
-            yield fuse.Direntry(relationship)
+            yield self._get_entry(relationship, state.attrs[relationship].loaded_value)
 
     def parse(self, path):
-        logger.debug("Parsing {}".format(path))
+        logger.debug("Parsing %s", path)
         # Reset vars
         self.table = None
         self.field_path = []
         self.field = None
         self.fields = []
         self.obj = None
+        self.data = None
 
         path.pop(0)
         self.table = self.cls_name
@@ -215,13 +444,20 @@ class TreeTablePath(TablePath):
         # Check the existance of the id
         if not path:
             return
-        if self.filtered_stmt == None:
-            stmt = self.session.query(self.cls_name)
+        options = get_load_options(self.cls_name, self.load_plan)
+        if self.ids is not None:
+            obj = None
+            if self._has_id(path[0]):
+                obj = self.session.get(self.cls_name, int(path[0]), options=options)
         else:
-            stmt = self.filtered_stmt
-        stmt = stmt.filter(getattr(self.cls_name, self.pk) == path[0])
-        result = self.session.execute(stmt)
-        obj = result.scalar()
+            if self.filtered_stmt == None:
+                stmt = select(self.cls_name)
+            else:
+                stmt = self.filtered_stmt
+            stmt = stmt.filter(getattr(self.cls_name, self.pk) == path[0])
+            stmt = stmt.options(*options)
+            result = self.session.execute(stmt)
+            obj = result.scalar()
         if obj:
             self.obj = obj
             path.pop(0)
@@ -233,9 +469,11 @@ class TreeTablePath(TablePath):
             self.field = self._get_field(path)
 
         logger.debug(
-            "Obj: {}, Field: {}, Field path {}, Fields: {}".format(
-                self.obj, self.field, self.field_path, self.fields
-            )
+            "Obj: %s, Field: %s, Field path %s, Fields: %s",
+            self.obj,
+            self.field,
+            self.field_path,
+            self.fields,
         )
 
     def getattr(self):
@@ -250,15 +488,73 @@ class TreeTablePath(TablePath):
             else:
                 ret = Stat()
                 ret.st_mode = S_IFREG | 0o444
-                ret.st_size = len(str(self.field))
+                ret.st_nlink = 1
+                ret.st_size = len(self._get_data())
         else:
             ret = Stat()
             ret.st_mode = S_IFDIR | 0o755
             ret.st_nlink = 2
+        if self.obj:
+            # Everything below an object has its modification time
+            mtime = get_timestamp(self.obj)
+            ret.st_mtime = ret.st_ctime = ret.st_atime = mtime
         return ret
 
+    def key(self):
+        if not self.obj:
+            return (self.cls_name.__tablename__,)
+        return (
+            self.cls_name.__tablename__,
+            getattr(self.obj, self.pk),
+            *self.field_path,
+        )
+
+    def _has_id(self, name):
+        try:
+            pk = int(name)
+        except ValueError:
+            return False
+        i = bisect_left(self.ids, pk)
+        return i < len(self.ids) and self.ids[i] == pk
+
+    def _get_ids(self, last=None):
+        """
+        Primary keys of the table greater than last, fetched in batches
+        """
+        if self.ids is not None:
+            start = 0 if last is None else bisect_right(self.ids, last)
+            yield from islice(self.ids, start, None)
+            return
+        pk = getattr(self.cls_name, self.pk)
+        if self.filtered_stmt == None:
+            stmt = select(pk)
+        else:
+            stmt = self.filtered_stmt.with_only_columns(pk)
+        stmt = stmt.order_by(pk).limit(self.batch_size)
+        while True:
+            batch_stmt = stmt if last is None else stmt.where(pk > last)
+            ids = self.session.execute(batch_stmt).scalars().all()
+            yield from ids
+            if len(ids) < self.batch_size:
+                break
+            last = ids[-1]
+
+    def _readdir_table(self, offset):
+        # The offset of an entry is its primary key plus the common entries,
+        # a listing is resumed from the next primary key
+        for i, r in enumerate([".", ".."], 1):
+            if offset < i:
+                yield fuse.Direntry(r, offset=i)
+        last = offset - 2 if offset > 2 else None
+        for pk in self._get_ids(last):
+            yield fuse.Direntry(str(pk), offset=pk + 2)
+
     def readdir(self, offset):
-        logger.debug("Reading directory {}".format(self.field_path))
+        logger.debug("Reading directory %s", self.field_path)
+        if not self.field and not self.obj:
+            yield from self._readdir_table(offset)
+            return
+
         common = [".", ".."]
         for r in common:
             yield fuse.Direntry(r)
@@ -266,78 +562,120 @@ class TreeTablePath(TablePath):
         if self.field:
             if isinstance(self.field, Base):
                 yield from self._get_obj_contents(self.field)
+                yield from self._get_virtual_entries(self.object_fields)
             elif isinstance(self.field, InstrumentedList):
                 for i in self.field:
-                    # FIXME this can be done before the loop
-                    list_object_id = [
-                        f.name for f in type(i).__table__.columns if f.primary_key
-                    ][0]
-                    yield fuse.Direntry(str(getattr(i, list_object_id)))
-        elif self.obj:
+                    list_object_id = get_class_info(type(i)).pk
+                    yield self._get_entry(str(getattr(i, list_object_id)), i)
+        else:
             # Get the columns and relationships
             yield from self._get_obj_contents(self.obj)
             # Get the extra fields
-            for ef in self.extra_fields:
-                yield fuse.Direntry(ef[0])
-        else:
-            if self.filtered_stmt == None:
-                stmt = self.session.query(self.cls_name)
-            else:
-                stmt = self.filtered_stmt
-            result = self.session.execute(stmt)
-            for row in result.scalars().all():
-                yield fuse.Direntry(str(getattr(row, self.pk)))
+            yield from self._get_virtual_entries(self.extra_fields)
+            yield from self._get_virtual_entries(self.object_fields)
 
     def open(self, flags):
         if not self.field:
             raise FileNotFoundError
+        if isinstance(self.field, VirtualFile):
+            return self.field.open(flags)
+
+    def _get_data(self):
+        # Encoded once, the size and every chunk read are taken from it
+        if self.data is None:
+            self.data = str(self.field).encode("UTF-8")
+        return self.data
 
     def read(self, size, offset):
         if isinstance(self.field, VirtualFile):
             return self.field.read(size, offset)
         else:
-            sfield = str(self.field)
-            slen = len(sfield)
-            if offset < slen:
-                if offset + size > slen:
-                    size = slen - offset
-                buf = sfield[offset : offset + size]
-            else:
-                buf = ""
-            return bytes(buf, encoding="UTF-8")
+            return self._get_data()[offset : offset + size]
 
 
 class SearchTablePath(TablePath):
     """
     This class will parse paths in the form
     /<table>/<field>/<value>
+    where the value of numeric and date fields can be a range too
     """
 
+    # Fields with more distinct values are listed as ranges
+    max_values = 64
+
     def __init__(self, session, **kwargs):
         super().__init__(session)
         self.table = None
         self.field = None
         self.value = None
+        self.range = None
 
     def get_filter_clause(self, stmt):
-        return stmt.filter(getattr(self.cls_name, self.field) == self.value)
+        column = getattr(self.cls_name, self.field)
+        if self.range:
+            return stmt.filter(self.range.get_clause(column))
+        return stmt.filter(column == self.value)
+
+    def get_buckets(self):
+        """
+        Ranges to list the values of the field in, None when the field can not
+        be split in ranges or has few values
+        """
+        column = getattr(self.cls_name, self.field)
+        if not get_kind(column):
+            return None
+        database = get_database(self.session)
+        key = (self.cls_name, self.field)
+        if database and key in database.buckets:
+            return database.buckets[key]
+        stmt = select(func.count(column.distinct()))
+        buckets = None
+        if self.session.execute(stmt).scalar() > self.max_values:
+            buckets = get_buckets(self.session, column)
+        if database:
+            database.buckets[key] = buckets
+        return buckets
+
+    def get_index(self):
+        """
+        Sidecar index of the values of the field, if there is one ready
+        """
+        database = get_database(self.session)
+        if not database or not database.index or not database.index.ready:
+            return None
+        if self.range:
+            return None
+        if not database.index.has_column(self.cls_name, self.field):
+            return None
+        return database.index
 
     def parse(self, path):
-        logger.debug("Parsing {}".format(path))
+        logger.debug("Parsing %s", path)
         path.pop(0)
         self.table = self.cls_name
         # Check the existance of the field
         if len(path):
-            if path[0] in [f.name for f in self.cls_name.__table__.columns]:
+            if path[0] in get_class_info(self.cls_name).table_columns:
                 self.field = path.pop(0)
-                # Check the existance of the value
+                column = getattr(self.cls_name, self.field)
                 if len(path):
+                    self.range = parse_range(path[0], column)
+                if self.range:
+                    self.value = path.pop(0)
+                # Check the existance of the value
+                elif len(path):
                     value = path[0].replace("_-_", os.path.sep)
-                    value_exists = self.session.query(
-                        self.session.query(self.cls_name)
-                        .filter(getattr(self.cls_name, self.field) == value)
-                        .exists()
-                    ).scalar()
+                    index = self.get_index()
+                    if index:
+                        value_exists = index.has_value(
+                            self.cls_name, self.field, path[0]
+                        )
+                    else:
+                        value_exists = self.session.query(
+                            self.session.query(self.cls_name)
+                            .filter(getattr(self.cls_name, self.field) == value)
+                            .exists()
+                        ).scalar()
                     if value_exists:
                         self.value = value
                         path.pop(0)
@@ -353,8 +691,17 @@ class SearchTablePath(TablePath):
         # ret.st_mtime = self.now,
         # ret.st_atime = self.now,
         ret.st_nlink = 2
+        if self.range:
+            # The size of a listed range is its number of rows
+            for b in self.get_buckets() or []:
+                if b.name == self.value:
+                    ret.st_size = b.count
         return ret
 
+    def key(self):
+        key = (self.cls_name.__name__, self.field, self.value)
+        return tuple([k for k in key if k is not None])
+
     def readdir(self, offset):
         common = [".", ".."]
         for r in common:
@@ -363,14 +710,18 @@ class SearchTablePath(TablePath):
             # Get all the columns
             for f in self._get_columns():
                 yield fuse.Direntry(f)
+        elif self.get_buckets() is not None:
+            for b in self.get_buckets():
+                yield fuse.Direntry(b.name)
+        elif self.get_index():
+            for name, _count in self.get_index().get_values(self.cls_name, self.field):
+                yield fuse.Direntry(name)
         else:
             # Get all the values
-            stmt = self.session.query(getattr(self.cls_name, self.field)).distinct()
+            stmt = select(getattr(self.cls_name, self.field)).distinct()
             result = self.session.execute(stmt)
             for obj in result.scalars():
-                # Make the value "pathable", change / by _-_
-                dirname = str(obj).replace(os.path.sep, "_-_")
-                yield fuse.Direntry(dirname)
+                yield fuse.Direntry(to_path_name(obj))
 
 
 class RootPath(Path):
@@ -420,9 +771,25 @@ class RootPath(Path):
             # ret.st_mtime = self.now,
             # ret.st_atime = self.now,
             ret.st_nlink = 2
-            return ret
         else:
-            return self.child_path.getattr()
+            ret = self.child_path.getattr()
+        ret.st_ino = get_inode(self.key())
+        return ret
+
+    def readlink(self):
+        if not self.child_path:
+            return super().readlink()
+        return self.child_path.readlink()
+
+    def key(self):
+        if not self.child_path:
+            return ()
+        return self.child_path.key()
+
+    def get_leaf(self):
+        if not self.child_path:
+            return self
+        return self.child_path.get_leaf()
 
     def readdir(self, offset):
         if not self.child_path:
@@ -431,7 +798,408 @@ class RootPath(Path):
             for p, _unsued in self.cls_paths:
                 yield fuse.Direntry(p)
         else:
-            yield from self.child_path.readdir(offset)
+            key = self.key()
+            for entry in self.child_path.readdir(offset):
+                # The attributes known are completed with the inode
+                stat = getattr(entry, "stat", None)
+                if stat:
+                    stat.st_ino = entry.ino = get_inode(key + (entry.name,))
+                yield entry
+
+
+class ExportHandle(object):
+    """
+    Handle of an export, the rows are read in batches ordered by key and
+    encoded as they are read. Every batch is a short query of its own resumed
+    after the last key, so no transaction is kept open while the file is.
+    Only sequential reads are cheap, reading again from a previous offset runs
+    the export again
+    """
+
+    # Do not let the kernel cache the file or rely on its size
+    direct_io = True
+
+    def __init__(self, engine, stmt, fmt, key, batch_size=1000):
+        self.engine = engine
+        self.stmt = stmt
+        self.format = fmt
+        # Unique column the rows are ordered by
+        self.key = key
+        self.batch_size = batch_size
+        self.keys = list(stmt.selected_columns.keys())
+        self.lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        # Offset of the first byte of the buffer
+        self.offset = 0
+        self.buffer = bytearray()
+        self.last = None
+        self.done = False
+        if self.format == "csv":
+            self.buffer += self._encode_csv([self.keys])
+
+    def _fetch(self):
+        """
+        Next batch of rows
+        """
+        stmt = self.stmt.add_columns(self.key).limit(self.batch_size)
+        if self.last is not None:
+            stmt = stmt.where(self.key > self.last)
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        if len(rows) < self.batch_size:
+            self.done = True
+        if rows:
+            self.last = rows[-1][-1]
+        return [row[:-1] for row in rows]
+
+    def _encode_csv(self, rows):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        for row in rows:
+            writer.writerow(["" if v is None else to_export_value(v) for v in row])
+        return out.getvalue().encode()
+
+    def _encode_jsonl(self, rows):
+        return b"".join(
+            [
+                json.dumps(dict(zip(self.keys, row)), default=to_export_value).encode()
+                + b"\n"
+                for row in rows
+            ]
+        )
+
+    def read(self, size, offset):
+        with self.lock:
+            if offset < self.offset:
+                logger.debug("Exporting again from %s to read %s", self.offset, offset)
+                self._start()
+            while self.offset + len(self.buffer) < offset + size and not self.done:
+                rows = self._fetch()
+                if self.format == "csv":
+                    self.buffer += self._encode_csv(rows)
+                else:
+                    self.buffer += self._encode_jsonl(rows)
+            start = offset - self.offset
+            data = bytes(self.buffer[start : start + size])
+            # Only what was not read yet is kept
+            consumed = min(start + len(data), len(self.buffer))
+            del self.buffer[:consumed]
+            self.offset += consumed
+            return data
+
+    def release(self):
+        # Nothing is kept open between the batches
+        pass
+
+
+class ExportPath(Path):
+    """
+    File with the given columns of every row, as JSON lines or CSV. The size
+    is not known so the files are served with direct_io
+    """
+
+    # Columns exported, of the statement given by get_join_stmt
+    columns = []
+    # Either jsonl or csv
+    format = "jsonl"
+
+    def __init__(self, session, **kwargs):
+        super().__init__(session)
+        # Statement of the rows to export, when restricted
+        self.filtered_stmt = kwargs.get("filtered")
+
+    def get_join_stmt(self):
+        raise NotImplementedError
+
+    def get_stmt(self):
+        stmt = self.filtered_stmt
+        if stmt is None:
+            stmt = self.get_join_stmt()
+        stmt = stmt.with_only_columns(*[c.label(c.key) for c in self.columns])
+        return stmt.order_by(self.columns[0])
+
+    def parse(self, paths):
+        paths.pop(0)
+        if paths:
+            raise FileNotFoundError
+
+    def get_engine(self):
+        # The batches of the handles are read on connections of their own
+        database = get_database(self.session)
+        if database and database.export_engine:
+            return database.export_engine
+        return self.session.get_bind()
+
+    def open(self, flags):
+        return ExportHandle(
+            self.get_engine(), self.get_stmt(), self.format, self.columns[0]
+        )
+
+    def read(self, size, offset):
+        handle = self.open(os.O_RDONLY)
+        try:
+            return handle.read(size, offset)
+        finally:
+            handle.release()
+
+    def readdir(self, offset):
+        raise FileNotFoundError
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        return ret
+
+    def key(self):
+        return ("export", self.format)
+
+
+class ResultLinksPath(Path):
+    """
+    This class will parse paths in the form
+    /<results>/<id>
+    Every result is a link to the object in its own tree, the membership is
+    checked here once and everything below is served from that tree
+    """
+
+    def __init__(self, session, **kwargs):
+        super().__init__(session)
+        # Table of the results, to check and list them
+        self.table_path = kwargs.get("table")
+        # Target of the links, relative to the directory of the results
+        self.target = kwargs.get("target")
+        self.id = None
+
+    def _has_id(self, name):
+        table = self.table_path
+        if table.ids is not None:
+            return table._has_id(name)
+        try:
+            pk = int(name)
+        except ValueError:
+            return False
+        column = getattr(table.cls_name, table.pk)
+        stmt = table.filtered_stmt.with_only_columns(column).where(column == pk)
+        return self.session.execute(stmt.limit(1)).first() is not None
+
+    def parse(self, paths):
+        paths.pop(0)
+        if not paths:
+            return
+        if not self._has_id(paths[0]):
+            raise FileNotFoundError
+        self.id = int(paths.pop(0))
+        # The kernel follows the link, nothing is looked up below it
+        if paths:
+            raise FileNotFoundError
+
+    def open(self, flags):
+        raise FileNotFoundError
+
+    def read(self, size, offset):
+        raise FileNotFoundError
+
+    def readdir(self, offset):
+        if self.id is not None:
+            raise FileNotFoundError
+        yield from self.table_path._readdir_table(offset)
+
+    def readlink(self):
+        if self.id is None:
+            return super().readlink()
+        return "{}/{}".format(self.target, self.id)
+
+    def getattr(self):
+        ret = Stat()
+        if self.id is None:
+            ret.st_mode = S_IFDIR | 0o755
+            ret.st_nlink = 2
+        else:
+            ret.st_mode = S_IFLNK | 0o777
+            ret.st_nlink = 1
+            ret.st_size = len(self.readlink())
+        return ret
+
+    def key(self):
+        if self.id is None:
+            return ("links",)
+        return ("links", self.id)
+
+
+class CountPath(Path):
+    """
+    File with the number of results of a search
+    """
+
+    def __init__(self, session, **kwargs):
+        super().__init__(session)
+        self.search = kwargs.get("search")
+        self.data = None
+
+    def parse(self, paths):
+        paths.pop(0)
+        if paths:
+            raise FileNotFoundError
+
+    def _get_data(self):
+        if self.data is None:
+            self.data = "{}\n".format(self.search.get_count()).encode()
+        return self.data
+
+    def open(self, flags):
+        pass
+
+    def read(self, size, offset):
+        return self._get_data()[offset : offset + size]
+
+    def readdir(self, offset):
+        raise FileNotFoundError
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        ret.st_size = len(self._get_data())
+        return ret
+
+    def key(self):
+        return ("count",)
+
+
+class ResultPagesPath(Path):
+    """
+    This class will parse paths in the form
+    /pages/<first id>/<id>/<field>
+    The results are split in pages of page_size ids, named by their first id.
+    Every page is fetched with a keyset query, any result can start one, the
+    whole results are only needed to list the pages
+    """
+
+    page_size = 1000
+
+    def __init__(self, session, **kwargs):
+        super().__init__(session)
+        self.search = kwargs.get("search")
+        # Number of directories above the pages
+        self.depth = kwargs.get("depth", 0)
+        self.start = None
+        self.result_path = None
+
+    def _get_pk(self):
+        cls = self.search.results.cls_name
+        return getattr(cls, get_class_info(cls).pk)
+
+    def _get_page(self, start):
+        ids = self.search.get_cached_ids()
+        if ids is not None:
+            i = bisect_left(ids, start)
+            page = ids[i : i + self.page_size]
+        else:
+            # Every path below the page looks it up again
+            database = get_database(self.session)
+            cache = database.results if database else None
+            key = self.search._get_cache_key() + (("page", start),)
+            page = cache.get(key) if cache is not None else None
+            if page is None:
+                pk = self._get_pk()
+                stmt = self.search.get_stmt().with_only_columns(pk)
+                stmt = stmt.where(pk >= start).order_by(pk).limit(self.page_size)
+                page = array("q", self.session.execute(stmt).scalars())
+                if cache is not None:
+                    cache.put(key, page)
+        if not page or page[0] != start:
+            return None
+        return page
+
+    def _get_bounds(self, last=None):
+        """
+        First and last id of the pages after the id last
+        """
+        ids = self.search.get_cached_ids()
+        if ids is not None:
+            start = 0 if last is None else bisect_right(ids, last)
+            for i in range(start, len(ids), self.page_size):
+                yield ids[i], ids[min(i + self.page_size, len(ids)) - 1]
+            return
+        # Only the bounds of every page are kept while walking the results
+        pk = self._get_pk()
+        stmt = self.search.get_stmt().with_only_columns(pk)
+        stmt = stmt.order_by(pk).limit(self.page_size)
+        while True:
+            page_stmt = stmt if last is None else stmt.where(pk > last)
+            ids = self.session.execute(page_stmt).scalars().all()
+            if not ids:
+                break
+            yield ids[0], ids[-1]
+            if len(ids) < self.page_size:
+                break
+            last = ids[-1]
+
+    def parse(self, paths):
+        paths.pop(0)
+        if not paths:
+            return
+        try:
+            self.start = int(paths[0])
+        except ValueError:
+            raise FileNotFoundError
+        ids = self._get_page(self.start)
+        if ids is None:
+            raise FileNotFoundError
+        self.result_path = self.search.create_results(
+            self.search.get_stmt(), ids, self.depth + 2
+        )
+        # The page is listed as the table of the results
+        self.result_path.parse(paths)
+
+    def open(self, flags):
+        if not self.result_path:
+            raise FileNotFoundError
+        return self.result_path.open(flags)
+
+    def read(self, size, offset):
+        if not self.result_path:
+            raise FileNotFoundError
+        return self.result_path.read(size, offset)
+
+    def readlink(self):
+        if not self.result_path:
+            return super().readlink()
+        return self.result_path.readlink()
+
+    def readdir(self, offset):
+        if self.result_path:
+            yield from self.result_path.readdir(offset)
+            return
+        # The offset of a page is its last id, a listing is resumed from the
+        # next page
+        for i, r in enumerate([".", ".."], 1):
+            if offset < i:
+                yield fuse.Direntry(r, offset=i)
+        last = offset - 2 if offset > 2 else None
+        for first, end in self._get_bounds(last):
+            yield fuse.Direntry(str(first), offset=end + 2)
+
+    def getattr(self):
+        if self.result_path:
+            return self.result_path.getattr()
+        ret = Stat()
+        ret.st_mode = S_IFDIR | 0o755
+        ret.st_nlink = 2
+        return ret
+
+    def key(self):
+        if not self.result_path:
+            return ("pages",)
+        return ("pages", self.start) + self.result_path.key()
+
+    def get_leaf(self):
+        if self.result_path:
+            return self.result_path.get_leaf()
+        return self
 
 
 class SearchPath(Path):
@@ -442,14 +1210,36 @@ class SearchPath(Path):
 
     queries = []
     results = None
+    # Files with every result: name, ExportPath class
+    exports = []
+    # Other entries about the results: name, Path class
+    result_paths = [("count", CountPath), ("pages", ResultPagesPath)]
+    # Directory of the results tree relative to the root, the results are
+    # links to it when link_results is set
+    results_dir = None
+    link_results = False
 
     def __init__(self, session, **kwargs):
         super().__init__(session)
         self.child_paths = []
         self.result_path = None
+        # Count, pages or export of the results
+        self.extra_path = None
+
+    def _create_extra_path(self, name, depth):
+        for e, cls in self.result_paths:
+            if e == name:
+                return cls(self.session, search=self, depth=depth)
+        for e, cls in self.exports:
+            if e == name:
+                return cls(self.session, filtered=self.get_stmt())
+        return None
 
     def parse(self, paths):
         self.child_paths = []
+        self.extra_path = None
+        # Components of the path up to the current one
+        total = len(paths)
         paths.pop(0)
         while paths:
             p = paths[0]
@@ -462,22 +1252,104 @@ class SearchPath(Path):
                 self.child_paths.append(pc)
                 found = True
 
-            if not found and not self.result_path:
+            if not found:
+                if self.result_path or self.extra_path:
+                    raise FileNotFoundError
                 # Check we are in the results level
+                depth = total - len(paths)
                 if p == "results":
-                    # Get the select statement to generate the dynamic query
-                    stmt = self.get_join_stmt()
-                    # Get the filters for each query
-                    for q in self.child_paths:
-                        stmt = q.get_filter_clause(stmt)
-                    stmt = stmt.distinct()
-                    self.result_path = self.results(self.session, filtered=stmt)
+                    self.result_path = self.get_results(depth + 1)
                     self.result_path.parse(paths)
-                else:
+                    continue
+                self.extra_path = self._create_extra_path(p, depth)
+                if not self.extra_path:
                     raise FileNotFoundError
+                self.extra_path.parse(paths)
+
+    def _get_filtered_stmt(self):
+        # Get the select statement to generate the dynamic query
+        stmt = self.get_join_stmt()
+        # Get the filters for each query
+        for q in self.child_paths:
+            stmt = q.get_filter_clause(stmt)
+        return stmt
+
+    def get_stmt(self):
+        return self._get_filtered_stmt().distinct()
+
+    def _get_cache_key(self):
+        return tuple([q.key() for q in self.child_paths])
+
+    def get_cached_ids(self):
+        """
+        Sorted ids of the results when they are known without running the
+        search: cached or intersected from the index
+        """
+        database = get_database(self.session)
+        cache = database.results if database else None
+        key = self._get_cache_key()
+        ids = cache.get(key) if cache is not None else None
+        if ids is None:
+            ids = self._get_indexed_ids()
+            if ids is not None:
+                ids = array("q", ids)
+                if cache is not None:
+                    cache.put(key, ids)
+        return ids
+
+    def create_results(self, stmt, ids, depth):
+        """
+        Path of the given results, depth is the number of directories above
+        them
+        """
+        table = self.results(self.session, filtered=stmt, ids=ids)
+        if not self.link_results:
+            return table
+        target = "/".join([".."] * depth + [self.results_dir])
+        return ResultLinksPath(self.session, table=table, target=target)
+
+    def get_results(self, depth):
+        stmt = self.get_stmt()
+        # The ids matching the filters are kept for the next lookups when
+        # they fit, otherwise every lookup checks its own id
+        database = get_database(self.session)
+        cache = database.results if database else None
+        key = self._get_cache_key()
+        ids = self.get_cached_ids()
+        if ids is None and cache is not None and cache.fits(key):
+            capacity = cache.get_capacity()
+            ids = array("q", self._get_ids(stmt, capacity + 1))
+            cache.put(key, ids)
+            if len(ids) > capacity:
+                ids = None
+        return self.create_results(stmt, ids, depth)
+
+    def get_count(self):
+        ids = self.get_cached_ids()
+        if ids is not None:
+            return len(ids)
+        pk = getattr(self.results.cls_name, get_class_info(self.results.cls_name).pk)
+        stmt = self._get_filtered_stmt().with_only_columns(func.count(distinct(pk)))
+        return self.session.execute(stmt).scalar()
+
+    def _get_indexed_ids(self):
+        # Intersect the files of every value when all of them are indexed
+        indexes = [q.get_index() for q in self.child_paths if q.value is not None]
+        if not indexes or len(indexes) != len(self.child_paths) or not all(indexes):
+            return None
+        return indexes[0].get_files(
+            [(q.cls_name, q.field, to_path_name(q.value)) for q in self.child_paths]
+        )
+
+    def _get_ids(self, stmt, limit=None):
+        pk = getattr(self.results.cls_name, get_class_info(self.results.cls_name).pk)
+        stmt = stmt.with_only_columns(pk).order_by(pk).limit(limit)
+        return self.session.execute(stmt).scalars()
 
     def open(self, flags):
-        if self.result_path:
+        if self.extra_path:
+            return self.extra_path.open(flags)
+        elif self.result_path:
             return self.result_path.open(flags)
         elif self.child_paths:
             return self.child_paths[-1].open(flags)
@@ -485,7 +1357,9 @@ class SearchPath(Path):
             raise FileNotFoundError
 
     def read(self, size, offset):
-        if self.result_path:
+        if self.extra_path:
+            return self.extra_path.read(size, offset)
+        elif self.result_path:
             return self.result_path.read(size, offset)
         elif self.child_paths:
             return self.child_paths[-1].read(size, offset)
@@ -493,7 +1367,9 @@ class SearchPath(Path):
             raise FileNotFoundError
 
     def getattr(self):
-        if self.result_path:
+        if self.extra_path:
+            return self.extra_path.getattr()
+        elif self.result_path:
             return self.result_path.getattr()
         elif self.child_paths:
             return self.child_paths[-1].getattr()
@@ -506,8 +1382,38 @@ class SearchPath(Path):
             ret.st_nlink = 2
             return ret
 
-    def readdir(self, offset):
+    def readlink(self):
+        if self.extra_path:
+            return self.extra_path.readlink()
+        elif self.result_path:
+            return self.result_path.readlink()
+        return super().readlink()
+
+    def key(self):
+        # Every search has its own tree, same results in a different one included
+        key = ("search",)
+        for q in self.child_paths:
+            key += q.key()
         if self.result_path:
+            key += ("results",) + self.result_path.key()
+        elif self.extra_path:
+            key += self.extra_path.key()
+        return key
+
+    def get_leaf(self):
+        if self.extra_path:
+            return self.extra_path.get_leaf()
+        elif self.result_path:
+            return self.result_path.get_leaf()
+        # Still choosing the field or value of a query
+        if self.child_paths and self.child_paths[-1].value is None:
+            return self.child_paths[-1]
+        return self
+
+    def readdir(self, offset):
+        if self.extra_path:
+            yield from self.extra_path.readdir(offset)
+        elif self.result_path:
             yield from self.result_path.readdir(offset)
         else:
             ask_child = True
@@ -516,42 +1422,163 @@ class SearchPath(Path):
             elif self.child_paths and self.child_paths[-1].value:
                 ask_child = False
 
-            for r in ".", "..":
-                yield fuse.Direntry(r)
             if ask_child:
+                # The query lists the common entries too
                 yield from self.child_paths[-1].readdir(offset)
             else:
+                for r in ".", "..":
+                    yield fuse.Direntry(r)
                 for p, _unsued in self.queries:
                     yield fuse.Direntry(p)
                 yield fuse.Direntry("results")
+                for e, _unused in self.result_paths + self.exports:
+                    yield fuse.Direntry(e)
+
+
+class PathContext(object):
+    """
+    Per thread state of the PathParser
+    """
+
+    def __init__(self, session, cache_size, generation=0):
+        self.session = session
+        self.cache = PathCache(cache_size)
+        # Generation of the database the session was created from
+        self.generation = generation
+        # Objects changed in the database, True for all of them
+        self.expire = False
+        self.expired = []
 
 
-class PathParser(object):
-    def __init__(self, schema, root):
+class ListingAttrs(object):
+    """
+    Attributes of the entries of the listed directories, kept by directory in
+    the attrs PathCache of the parser
+    """
+
+    def put_attrs(self, path, entries):
+        """
+        Keep the attributes of the entries of a directory for the next
+        getattr calls
+        """
+        attrs = dict([(e.name, e.stat) for e in entries if getattr(e, "stat", None)])
+        if attrs:
+            self.attrs.put(path.rstrip(os.path.sep) or os.path.sep, attrs)
+
+    def get_attr(self, path):
+        """
+        Attributes of a path from the listing of its directory, if any
+        """
+        parent, name = os.path.split(path)
+        attrs = self.attrs.get(parent)
+        return attrs.get(name) if attrs else None
+
+
+class PathParser(ListingAttrs):
+    """
+    Resolves paths into Path instances. Every thread gets its own session and
+    cache of resolved paths, so paths can be parsed from several threads at once
+    """
+
+    def __init__(self, schema, root, cache_size=4096, max_objects=20000):
         self.schema = schema
-        self.session = self.schema.create_session()
-        self.root = root(self.session)
-        self.paths = []
+        self.root_cls = root
+        self.cache_size = cache_size
+        # Objects every session can keep loaded between requests, 0 for any
+        self.max_objects = max_objects
+        self.local = threading.local()
+        self.contexts = weakref.WeakSet()
+        # Attributes of the entries of the listed directories, by directory
+        self.attrs = PathCache(cache_size)
+        self.lock = threading.Lock()
+
+    def _get_context(self):
+        context = getattr(self.local, "context", None)
+        generation = getattr(self.schema, "generation", 0)
+        if context and context.generation != generation:
+            # The database was replaced, nothing loaded from it is valid
+            context.session.close()
+            context = None
+        if not context:
+            context = PathContext(
+                self.schema.create_session(), self.cache_size, generation
+            )
+            self.local.context = context
+            with self.lock:
+                self.contexts.add(context)
+        elif context.expire or context.expired:
+            # Make sure the objects are loaded again from the database
+            with self.lock:
+                expire, context.expire = context.expire, False
+                expired, context.expired = context.expired, []
+            if expire:
+                context.session.expire_all()
+            for cls, pk in expired:
+                obj = context.session.identity_map.get(identity_key(cls, pk))
+                if obj:
+                    context.session.expire(obj)
+        return context
+
+    @property
+    def session(self):
+        return self._get_context().session
+
+    @property
+    def cache(self):
+        return self._get_context().cache
 
     def parse(self, path):
         if not len(path):
             raise FileNotFoundError
+        context = self._get_context()
         # corresponding Path instance
-        self.paths = path.split(os.path.sep)
-        self.root.parse(list(self.paths))
-
-    def open(self, flags):
-        logger.debug("Open {}".format(self.paths))
-        return self.root.open(flags)
-
-    def read(self, size, offset):
-        logger.debug("Read {}".format(self.paths))
-        return self.root.read(size, offset)
-
-    def readdir(self, offset):
-        logger.debug("Readdir {}".format(self.paths))
-        return self.root.readdir(offset)
-
-    def getattr(self):
-        logger.debug("Getattr {}".format(self.paths))
-        return self.root.getattr()
+        root = context.cache.get(path)
+        if not root:
+            root = self.root_cls(context.session)
+            root.parse(path.split(os.path.sep))
+            context.cache.put(path, root)
+        return root
+
+    def invalidate(self, path=None, objects=None):
+        """
+        Forget the resolved paths below path and the (class, primary key)
+        objects given, or everything when nothing is given
+        """
+        if path:
+            self.attrs.invalidate(path)
+        elif not objects:
+            self.attrs.clear()
+        with self.lock:
+            for context in self.contexts:
+                if path:
+                    context.cache.invalidate(path)
+                if objects:
+                    context.expired.extend(objects)
+                if not path and not objects:
+                    context.cache.clear()
+                    context.expire = True
+
+    def get_sizes(self):
+        """
+        Objects loaded and paths resolved by all the threads
+        """
+        with self.lock:
+            contexts = list(self.contexts)
+        return {
+            "objects": sum([len(c.session.identity_map) for c in contexts]),
+            "paths": sum([len(c.cache) for c in contexts]),
+        }
+
+    def release(self):
+        """
+        Give back the database connection of the current thread once a request
+        is done. The loaded objects are kept up to max_objects
+        """
+        context = self._get_context()
+        context.session.commit()
+        objects = len(context.session.identity_map)
+        if self.max_objects and objects > self.max_objects:
+            # The resolved paths point to the objects, both are dropped
+            logger.debug("Dropping %s objects of the session", objects)
+            context.cache.clear()
+            context.session.expunge_all()
@@ -0,0 +1,194 @@
+import logging
+import re
+from collections import namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import and_, case, func, select
+
+logger = logging.getLogger(__name__)
+
+# Multipliers of the values of a column, the duration is in nanoseconds
+time_units = [
+    ("h", 3600 * 10**9),
+    ("m", 60 * 10**9),
+    ("s", 10**9),
+    ("ms", 10**6),
+    ("us", 10**3),
+    ("ns", 1),
+    ("", 1),
+]
+number_units = [("G", 10**9), ("M", 10**6), ("k", 10**3), ("", 1)]
+column_units = {"duration": time_units}
+
+# Bucket widths, in the first unit they are tried with
+time_steps = [1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600]
+number_steps = [1, 2, 5]
+
+
+class Range(namedtuple("Range", ["low", "high", "low_inclusive", "high_inclusive"])):
+    """
+    Range of values of a column, any of the ends can be None
+    """
+
+    __slots__ = ()
+
+    def get_clause(self, column):
+        clauses = []
+        if self.low is not None:
+            clauses.append(
+                column >= self.low if self.low_inclusive else column > self.low
+            )
+        if self.high is not None:
+            clauses.append(
+                column <= self.high if self.high_inclusive else column < self.high
+            )
+        return and_(*clauses)
+
+
+Bucket = namedtuple("Bucket", ["name", "range", "count"])
+
+
+def get_kind(column):
+    """
+    Either number or date for the columns that can be searched by ranges
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if issubclass(python_type, bool):
+        return None
+    if issubclass(python_type, (int, float)):
+        return "number"
+    if issubclass(python_type, (datetime, date)):
+        return "date"
+    return None
+
+
+def parse_value(text, column):
+    if get_kind(column) == "date":
+        return datetime.fromisoformat(text)
+    for suffix, multiplier in column_units.get(column.key, number_units):
+        if suffix and not text.endswith(suffix):
+            continue
+        number = text[: len(text) - len(suffix)]
+        # A value in ms does not match as seconds
+        if not re.fullmatch(r"-?[0-9]+(\.[0-9]+)?", number):
+            continue
+        value = float(number) * multiplier
+        return int(value) if value.is_integer() else value
+    raise ValueError("Invalid value {}".format(text))
+
+
+def format_value(value, column):
+    if isinstance(value, datetime):
+        if value.time() == datetime.min.time():
+            return value.date().isoformat()
+        return value.isoformat()
+    for suffix, multiplier in column_units.get(column.key, number_units):
+        if value and value % multiplier == 0:
+            return "{}{}".format(int(value // multiplier), suffix)
+    return str(value)
+
+
+def parse_range(text, column):
+    """
+    Parse >=A, >A, <=A, <A, A..B, A.. or ..B into a range, the ranges with
+    both ends include the low one only. None when it is not a range
+    """
+    if not get_kind(column):
+        return None
+    try:
+        for op, inclusive in [(">=", True), ("<=", True), (">", False), ("<", False)]:
+            if text.startswith(op):
+                value = parse_value(text[len(op) :], column)
+                if op[0] == ">":
+                    return Range(value, None, inclusive, False)
+                return Range(None, value, False, inclusive)
+        if ".." in text:
+            low, high = text.split("..", 1)
+            return Range(
+                parse_value(low, column) if low else None,
+                parse_value(high, column) if high else None,
+                True,
+                False,
+            )
+    except ValueError:
+        return None
+    return None
+
+
+def _get_number_bounds(low, high, column, count):
+    scale = 1
+    steps = []
+    if column_units.get(column.key) == time_units:
+        steps = [s * 10**9 for s in time_steps]
+        scale = steps[-1] * 10
+    # Wider steps until less than count of them cover the values, however far
+    # apart they are
+    while not steps or (high - low) / steps[-1] >= count:
+        steps += [s * scale for s in number_steps]
+        scale *= 10
+    step = [s for s in steps if (high - low) / s < count][0]
+    start = (low // step) * step
+    bounds = [start]
+    while bounds[-1] <= high:
+        bounds.append(bounds[-1] + step)
+    return bounds
+
+
+def _get_date_bounds(low, high, count):
+    years = high.year - low.year
+    if years >= count:
+        step = -(-years // count)
+        bounds = [datetime(low.year - low.year % step, 1, 1)]
+        while bounds[-1] <= high:
+            bounds.append(datetime(bounds[-1].year + step, 1, 1))
+    elif years > 1:
+        bounds = [datetime(y, 1, 1) for y in range(low.year, high.year + 2)]
+    else:
+        month = datetime(low.year, low.month, 1)
+        bounds = [month]
+        while bounds[-1] <= high:
+            m = bounds[-1]
+            bounds.append(datetime(m.year + m.month // 12, m.month % 12 + 1, 1))
+    return bounds
+
+
+def get_buckets(session, column, count=16):
+    """
+    Split the values of a column in about count ranges of the same width, with
+    the number of rows in each one. Empty ranges are not returned
+    """
+    low, high = session.execute(select(func.min(column), func.max(column))).one()
+    if low is None:
+        return []
+    if get_kind(column) == "date":
+        if not isinstance(low, datetime):
+            low = datetime(low.year, low.month, low.day)
+            high = datetime(high.year, high.month, high.day)
+        bounds = _get_date_bounds(low, high, count)
+    else:
+        bounds = _get_number_bounds(low, high, column, count)
+    ranges = [Range(l, h, True, False) for l, h in zip(bounds, bounds[1:])]
+    # Count the rows of every range at once
+    index = case(
+        *[(r.get_clause(column), i) for i, r in enumerate(ranges)], else_=None
+    ).label("bucket")
+    stmt = (
+        select(index, func.count())
+        .where(column.isnot(None))
+        .group_by(index)
+        .order_by(index)
+    )
+    buckets = []
+    for i, n in session.execute(stmt):
+        if i is None:
+            continue
+        r = ranges[i]
+        name = "{}..{}".format(
+            format_value(r.low, column), format_value(r.high, column)
+        )
+        buckets.append(Bucket(name, r, n))
+    logger.debug("Buckets of %s: %s", column, buckets)
+    return buckets
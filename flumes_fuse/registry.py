@@ -0,0 +1,151 @@
+import logging
+from collections import namedtuple
+from types import MappingProxyType
+
+from flumes.schema import Base
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    selectinload,
+    subqueryload,
+    with_polymorphic,
+)
+
+logger = logging.getLogger(__name__)
+
+Relationship = namedtuple("Relationship", ["key", "target", "uselist", "direction"])
+
+# Strategies to load the relationships with, by name
+load_strategies = {
+    "joined": joinedload,
+    "selectin": selectinload,
+    "subquery": subqueryload,
+    "lazy": lazyload,
+}
+
+
+class ClassInfo(
+    namedtuple(
+        "ClassInfo",
+        ["cls", "pk", "columns", "all_columns", "table_columns", "relationships"],
+    )
+):
+    """
+    Schema metadata of a mapped class: the name of its primary key, its
+    columns with and without the primary key, every column of its table and
+    its relationships
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, mapped):
+        all_columns = tuple(
+            [c.name for c in mapped.__table__.columns if hasattr(mapped, c.name)]
+        )
+        pk = [c.name for c in mapped.__table__.columns if c.primary_key][0]
+        relationships = MappingProxyType(
+            {
+                r.key: Relationship(r.key, r.mapper.class_, r.uselist, r.direction)
+                for r in mapped.__mapper__.relationships
+                if hasattr(mapped, r.key)
+            }
+        )
+        return cls(
+            mapped,
+            pk,
+            tuple([c for c in all_columns if c != pk]),
+            all_columns,
+            frozenset([c.name for c in mapped.__table__.columns]),
+            relationships,
+        )
+
+
+# Mapped class -> ClassInfo
+registry = {}
+
+
+def build_registry(base=Base):
+    """
+    Gather the metadata of every class mapped in the schema
+    """
+    for mapper in base.registry.mappers:
+        registry[mapper.class_] = ClassInfo.create(mapper.class_)
+    logger.debug("Registered %s classes", len(registry))
+
+
+def get_class_info(cls):
+    info = registry.get(cls)
+    if not info:
+        info = ClassInfo.create(cls)
+        registry[cls] = info
+    return info
+
+
+def get_join_path(src, dst):
+    """
+    Relationships to traverse to go from one mapped class to another, the
+    shortest path is returned
+    """
+    paths = {src: []}
+    pending = [src]
+    while pending:
+        cls = pending.pop(0)
+        if cls == dst:
+            return paths[cls]
+        for r in get_class_info(cls).relationships.values():
+            if r.target in paths:
+                continue
+            paths[r.target] = paths[cls] + [getattr(cls, r.key)]
+            pending.append(r.target)
+    return None
+
+
+def parse_load_plan(value):
+    """
+    Parse a plan of how to load relationships in the form
+    <class>.<relationship>:<strategy>;... into a dict of class to
+    (relationship, strategy) pairs
+    """
+    classes = {m.class_.__name__: m.class_ for m in Base.registry.mappers}
+    plan = {}
+    for entry in [e for e in value.split(";") if e]:
+        try:
+            attr, strategy = entry.split(":")
+            cls_name, key = attr.split(".")
+            cls = classes[cls_name]
+        except (ValueError, KeyError):
+            raise ValueError("Invalid load plan entry '{}'".format(entry))
+        if key not in get_class_info(cls).relationships:
+            raise ValueError("{} has no relationship {}".format(cls_name, key))
+        if strategy not in load_strategies:
+            raise ValueError("Unknown load strategy '{}'".format(strategy))
+        plan.setdefault(cls, []).append((key, strategy))
+    return plan
+
+
+def get_load_options(cls, plan, visited=None, entity=None):
+    """
+    Loader options for the relationships of the plan reachable from a class,
+    every class is loaded once. The subclasses of the related objects are
+    loaded with them
+    """
+    visited = (visited or set()) | {cls}
+    entity = entity or cls
+    options = []
+    for key, strategy in plan.get(cls, []):
+        target = get_class_info(cls).relationships[key].target
+        # Objects of the same class are only loaded one level down
+        if target in visited and target != cls:
+            continue
+        attr = getattr(entity, key)
+        target_entity = target
+        if len(target.__mapper__.self_and_descendants) > 1:
+            target_entity = with_polymorphic(target, "*")
+            attr = attr.of_type(target_entity)
+        loader = load_strategies[strategy](attr)
+        children = []
+        if target != cls:
+            children = get_load_options(target, plan, visited, target_entity)
+        options.append(loader.options(*children) if children else loader)
+    return options
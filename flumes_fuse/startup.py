@@ -0,0 +1,48 @@
+import contextlib
+import threading
+import time
+
+
+class StartupProfile(object):
+    """
+    Time spent on every step of the mount and until the first operation is
+    served
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # Name and seconds of every step, in the order they were done
+        self.steps = []
+        # Name and seconds since the start of the first operation served
+        self.first_op = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.steps.append((name, time.perf_counter() - start))
+
+    def add_op(self, op):
+        """
+        Record an operation served, True when it is the first one
+        """
+        with self.lock:
+            if self.first_op:
+                return False
+            self.first_op = (op, time.perf_counter() - self.started)
+            return True
+
+    def report(self):
+        with self.lock:
+            lines = ["{:<16} {:>9.1f} ms".format(n, t * 1000) for n, t in self.steps]
+            if self.first_op:
+                lines.append(
+                    "{:<16} {:>9.1f} ms since start".format(
+                        "first " + self.first_op[0], self.first_op[1] * 1000
+                    )
+                )
+        return "\n".join(["Startup profile"] + lines)
@@ -0,0 +1,182 @@
+import json
+import logging
+import threading
+import time
+
+from flumes.schema import Base
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .path import RootPath, SearchPath, SearchTablePath, TreeTablePath
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Latencies in power of two buckets of microseconds, with the SQL statements
+    issued and the rows loaded as objects
+    """
+
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.statements = 0
+        self.rows = 0
+
+    def add(self, elapsed, statements, rows):
+        us = int(elapsed * 1000000)
+        self.buckets[min(us.bit_length(), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.statements += statements
+        self.rows += rows
+
+    def percentile(self, p):
+        # Upper bound of the bucket, in milliseconds
+        target = self.count * p
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << i) / 1000
+        return 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "max_ms": self.max * 1000,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "sql": self.statements,
+            "rows": self.rows,
+            "buckets_us": {
+                "<{}".format(1 << i): n for i, n in enumerate(self.buckets) if n
+            },
+        }
+
+
+class Record(object):
+    def __init__(self, op):
+        self.op = op
+        self.path_cls = None
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+
+
+class Stats(object):
+    """
+    Latency histograms of the filesystem operations, by operation and by the
+    class of the path they were done on
+    """
+
+    # Kind of paths the operations are grouped by, the first match is used
+    path_classes = [TreeTablePath, SearchTablePath, SearchPath, RootPath]
+
+    def __init__(self):
+        self.histograms = {}
+        # Current values reported with the statistics: name, function
+        self.gauges = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        # Any engine, the served database can be replaced
+        event.listen(Engine, "before_cursor_execute", self._statement)
+        event.listen(Base, "load", self._load, propagate=True)
+
+    def close(self):
+        """
+        Stop counting the statements and rows, the listeners are global
+        """
+        event.remove(Engine, "before_cursor_execute", self._statement)
+        event.remove(Base, "load", self._load)
+
+    def add_gauge(self, name, fn):
+        self.gauges.append((name, fn))
+
+    def get_gauges(self):
+        gauges = {}
+        for name, fn in self.gauges:
+            value = fn()
+            if isinstance(value, dict):
+                gauges.update([("{}_{}".format(name, k), v) for k, v in value.items()])
+            else:
+                gauges[name] = value
+        return gauges
+
+    def start(self, op):
+        self.local.record = Record(op)
+
+    def set_path(self, path):
+        record = getattr(self.local, "record", None)
+        if not record:
+            return
+        leaf = path.get_leaf()
+        record.path_cls = type(leaf).__name__
+        for cls in self.path_classes:
+            if isinstance(leaf, cls):
+                record.path_cls = cls.__name__
+                break
+
+    def stop(self):
+        record = getattr(self.local, "record", None)
+        if not record:
+            return
+        self.local.record = None
+        elapsed = time.perf_counter() - record.start
+        keys = [record.op]
+        if record.path_cls:
+            keys.append("{} {}".format(record.op, record.path_cls))
+        with self.lock:
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if not histogram:
+                    histogram = Histogram()
+                    self.histograms[key] = histogram
+                histogram.add(elapsed, record.statements, record.rows)
+
+    def to_dict(self):
+        gauges = self.get_gauges()
+        with self.lock:
+            return {
+                "enabled": True,
+                "uptime": time.time() - self.started,
+                "gauges": gauges,
+                "ops": {k: h.to_dict() for k, h in sorted(self.histograms.items())},
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2).encode() + b"\n"
+
+    def summary(self):
+        gauges = ["{} {}".format(k, v) for k, v in self.get_gauges().items()]
+        with self.lock:
+            return ", ".join(
+                gauges
+                + [
+                    "{} {} p50 {}ms p99 {}ms sql {}".format(
+                        op,
+                        h.count,
+                        h.percentile(0.5),
+                        h.percentile(0.99),
+                        h.statements,
+                    )
+                    for op, h in sorted(self.histograms.items())
+                    if " " not in op
+                ]
+            )
+
+    def _statement(self, *args):
+        record = getattr(self.local, "record", None)
+        if record:
+            record.statements += 1
+
+    def _load(self, target, context):
+        record = getattr(self.local, "record", None)
+        if record:
+            record.rows += 1
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+from stat import S_IFREG
+
+from flumes.schema import Audio, Field, File, Info, Stream, Subtitle, Video
+from sqlalchemy.sql import select
+
+from .checksum import Checksums
+from .db import get_database, get_media_root
+from .files import FileHandle, FilePool, Prefetcher
+from .path import (
+    ExportPath,
+    Path,
+    RecordFile,
+    RootPath,
+    SearchPath,
+    SearchTablePath,
+    Stat,
+    TreeTablePath,
+    VirtualFile,
+)
+from .registry import get_class_info
+
+
+class FileContent(VirtualFile):
+    # Open descriptors of the media files and their read ahead, shared by all
+    # the mount
+    pool = FilePool()
+    prefetcher = Prefetcher()
+
+    def _real_file(self, obj):
+        # Media dir + path + name
+        return os.path.join(get_media_root(self.session), self.obj.path, self.obj.name)
+
+    def open(self, flags):
+        return FileHandle(self.pool, self._real_file(self.obj), self.prefetcher)
+
+    def read(self, size, offset):
+        handle = self.open(os.O_RDONLY)
+        try:
+            return handle.read(size, offset)
+        finally:
+            handle.release()
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        ret.st_size = os.path.getsize(self._real_file(self.obj))
+        return ret
+
+
+class ContentChecksum(FileContent):
+    """
+    Checksum of the media file, computed once by the pool of checksums
+    """
+
+    checksums = Checksums()
+    algorithm = None
+
+    def _get_data(self):
+        path = self._real_file(self.obj)
+        digest = self.checksums.get(
+            path, os.path.getsize(path), self.obj.mtime, self.algorithm
+        )
+        return "{}\n".format(digest).encode()
+
+    def open(self, flags):
+        pass
+
+    def read(self, size, offset):
+        return self._get_data()[offset : offset + size]
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        # Known without computing it, listing the files does not hash them
+        ret.st_size = hashlib.new(self.algorithm).digest_size * 2 + 1
+        return ret
+
+
+class ContentSha256(ContentChecksum):
+    algorithm = "sha256"
+
+
+class ContentMd5(ContentChecksum):
+    algorithm = "md5"
+
+
+class FilePath(TreeTablePath):
+    cls_name = File
+    extra_fields = [
+        ("contents", FileContent),
+        ("contents.sha256", ContentSha256),
+        ("contents.md5", ContentMd5),
+    ]
+    object_fields = [("record.json", RecordFile)]
+
+
+class FilesExport(ExportPath):
+    columns = [
+        File.id,
+        File.name,
+        File.path,
+        File.mtime,
+        Info.duration,
+        Info.seekable,
+        Info.live,
+        Info.audio_streams,
+        Info.video_streams,
+        Info.subtitle_streams,
+    ]
+
+    def get_join_stmt(self):
+        return select(File).outerjoin(File.info)
+
+
+class FilesJsonl(FilesExport):
+    format = "jsonl"
+
+
+class FilesCsv(FilesExport):
+    format = "csv"
+
+
+class SearchByFile(SearchTablePath):
+    cls_name = File
+
+
+class SearchByInfo(SearchTablePath):
+    cls_name = Info
+
+
+class SearchByStream(SearchTablePath):
+    cls_name = Stream
+
+
+class SearchBySubtitle(SearchTablePath):
+    cls_name = Subtitle
+
+
+class SearchByVideo(SearchTablePath):
+    cls_name = Video
+
+
+class SearchByAudio(SearchTablePath):
+    cls_name = Audio
+
+
+class SearchByField(SearchTablePath):
+    cls_name = Field
+
+
+class Search(SearchPath):
+    queries = [
+        ("file", SearchByFile),
+        ("info", SearchByInfo),
+        ("stream", SearchByStream),
+        ("video", SearchByVideo),
+        ("audio", SearchByAudio),
+        ("subtitle", SearchBySubtitle),
+        ("field", SearchByField),
+    ]
+    results = FilePath
+    results_dir = "files"
+    exports = [("results.jsonl", FilesJsonl), ("results.csv", FilesCsv)]
+
+    def get_join_stmt(self):
+        return select(File).join(File.info).join(Info.streams)
+
+
+class StatsHandle(object):
+    """
+    Statistics rendered when the file is opened, every read of the handle is
+    served from the same render
+    """
+
+    # The statistics change between reads, do not rely on the size
+    direct_io = True
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size, offset):
+        return self.data[offset : offset + size]
+
+    def release(self):
+        pass
+
+
+class StatsPath(Path):
+    """
+    Read only JSON file with the statistics of the operations
+    """
+
+    def _get_stats(self):
+        database = get_database(self.session)
+        if not database or not database.stats:
+            return json.dumps({"enabled": False}).encode() + b"\n"
+        return database.stats.to_json()
+
+    def parse(self, path):
+        path.pop(0)
+        if path:
+            raise FileNotFoundError
+
+    def open(self, flags):
+        return StatsHandle(self._get_stats())
+
+    def read(self, size, offset):
+        return self.open(os.O_RDONLY).read(size, offset)
+
+    def readdir(self, offset):
+        raise FileNotFoundError
+
+    def getattr(self):
+        ret = Stat()
+        ret.st_mode = S_IFREG | 0o444
+        ret.st_nlink = 1
+        ret.st_size = len(self._get_stats())
+        return ret
+
+    def key(self):
+        return (".stats",)
+
+
+class Root(RootPath):
+    cls_paths = [
+        ("files", FilePath),
+        ("files.jsonl", FilesJsonl),
+        ("files.csv", FilesCsv),
+        ("search", Search),
+        (".stats", StatsPath),
+    ]
+
+
+def get_search_columns():
+    """
+    Columns of the database the searches filter on
+    """
+    columns = []
+    for _name, query in Search.queries:
+        table = query.cls_name.__table__
+        info = get_class_info(query.cls_name)
+        columns.extend([table.c[c] for c in info.columns if c in table.c])
+    return columns
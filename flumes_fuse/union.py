@@ -0,0 +1,458 @@
+"""
+Union of the trees of several databases, the shards, in a single mount. The
+objects listed by id are named <shard>-<id>, everything below them is served
+by their shard alone. The other paths are looked up on every shard at once
+and their listings merged while they arrive
+"""
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import fuse
+from sqlalchemy import String, cast, literal
+
+from .cache import PathCache
+from .path import (
+    CountPath,
+    ExportHandle,
+    ExportPath,
+    ListingAttrs,
+    ResultLinksPath,
+    ResultPagesPath,
+    TreeTablePath,
+    get_inode,
+)
+
+logger = logging.getLogger(__name__)
+
+# Where a path of the union is served from. The shard and its own path when
+# it belongs to one, otherwise the shards that have the path and whether its
+# entries are ids of their objects
+Route = namedtuple("Route", ["shard", "path", "shards", "listing"])
+
+
+def is_listing(path):
+    """
+    Whether the entries of a directory are the ids of the objects of its shard
+    """
+    leaf = path.get_leaf()
+    if isinstance(leaf, TreeTablePath):
+        return leaf.obj is None
+    if isinstance(leaf, ResultLinksPath):
+        return leaf.id is None
+    if isinstance(leaf, ResultPagesPath):
+        return leaf.result_path is None
+    return False
+
+
+class ShardExportHandle(ExportHandle):
+    """
+    Export of a shard, without the names of the columns unless it is the
+    first one
+    """
+
+    def __init__(self, engine, stmt, fmt, key, header=True):
+        self.header = header
+        super().__init__(engine, stmt, fmt, key)
+
+    def _start(self):
+        super()._start()
+        if not self.header:
+            self.buffer.clear()
+
+    def get_size(self):
+        """
+        Bytes exported, once all of them were read
+        """
+        return self.offset + len(self.buffer)
+
+
+class UnionExportHandle(object):
+    """
+    Exports of every shard one after the other. Each one is started once the
+    previous one is read, reading again from a previous offset starts over
+    """
+
+    direct_io = True
+
+    def __init__(self, factories):
+        # Functions creating the handle of every shard
+        self.factories = factories
+        self.handle = None
+        self.lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self.release()
+        self.index = 0
+        # Offset where the export of the current shard starts
+        self.base = 0
+
+    def read(self, size, offset):
+        with self.lock:
+            if offset < self.base:
+                self._start()
+            data = bytearray()
+            while len(data) < size and self.index < len(self.factories):
+                if not self.handle:
+                    self.handle = self.factories[self.index]()
+                wanted = size - len(data)
+                chunk = self.handle.read(wanted, offset + len(data) - self.base)
+                data += chunk
+                if len(chunk) < wanted:
+                    # Done, the next shard starts where this one ended
+                    self.base += self.handle.get_size()
+                    self.handle.release()
+                    self.handle = None
+                    self.index += 1
+            return bytes(data)
+
+    def release(self):
+        if self.handle:
+            self.handle.release()
+            self.handle = None
+
+
+class UnionPath(object):
+    """
+    Path of the union, served by the path of a shard or merged from all of
+    them
+    """
+
+    def __init__(self, parser, route, path):
+        self.parser = parser
+        self.route = route
+        # Path of the shard it belongs to, or of the first one that has it
+        self.path = path
+
+    def _is_merged(self, *classes):
+        return self.route.shard is None and isinstance(self.path.get_leaf(), classes)
+
+    def _get_count_data(self):
+        counts = self.parser.fan_out(
+            self.route.shards,
+            lambda k, p: [p.parse(self.route.path).get_leaf().search.get_count()],
+        )
+        return "{}\n".format(sum([c for _k, c in counts])).encode()
+
+    def _create_export(self, shard, header):
+        def create():
+            leaf = self.parser.parsers[shard].parse(self.route.path).get_leaf()
+            # The ids are the ones of the union
+            columns = [c.label(c.key) for c in leaf.columns]
+            pk = leaf.columns[0]
+            prefix = self.parser.get_name(shard, "")
+            columns[0] = (literal(prefix) + cast(pk, String)).label(pk.key)
+            stmt = leaf.get_stmt().with_only_columns(*columns)
+            return ShardExportHandle(
+                leaf.get_engine(), stmt, leaf.format, pk, header=header
+            )
+
+        return create
+
+    def open(self, flags):
+        if self._is_merged(ExportPath):
+            return UnionExportHandle(
+                [
+                    self._create_export(k, i == 0)
+                    for i, k in enumerate(self.route.shards)
+                ]
+            )
+        if self._is_merged(CountPath):
+            return None
+        return self.path.open(flags)
+
+    def read(self, size, offset):
+        if self._is_merged(ExportPath):
+            handle = self.open(os.O_RDONLY)
+            try:
+                return handle.read(size, offset)
+            finally:
+                handle.release()
+        if self._is_merged(CountPath):
+            return self._get_count_data()[offset : offset + size]
+        return self.path.read(size, offset)
+
+    def getattr(self):
+        ret = self.path.getattr()
+        if self.route.shard is not None:
+            ret.st_ino = get_inode((self.route.shard,) + self.path.key())
+        elif self._is_merged(CountPath):
+            ret.st_size = len(self._get_count_data())
+        return ret
+
+    def readlink(self):
+        target = self.path.readlink()
+        if isinstance(self.path.get_leaf(), ResultLinksPath):
+            # The link points to the object listed by the union
+            head, _sep, name = target.rpartition("/")
+            target = "{}/{}".format(head, self.parser.get_name(self.route.shard, name))
+        return target
+
+    def readdir(self, offset):
+        if self.route.shard is not None:
+            return self._readdir_shard(offset)
+        if self.route.listing:
+            return self._readdir_listing(offset)
+        return self._readdir_merged()
+
+    def _readdir_shard(self, offset):
+        key = (self.route.shard,) + self.path.key()
+        for entry in self.path.readdir(offset):
+            stat = getattr(entry, "stat", None)
+            if stat:
+                stat.st_ino = entry.ino = get_inode(key + (entry.name,))
+            yield entry
+
+    def _readdir_listing(self, offset):
+        # The offset of an entry is the offset in its shard and the shard,
+        # the shards are listed one after the other from there
+        n = len(self.parser.parsers)
+        for i, r in enumerate([".", ".."], 1):
+            if offset < i:
+                yield fuse.Direntry(r, offset=i)
+        first, first_offset = -1, 0
+        if offset > 2:
+            first_offset, first = divmod(offset - 2, n)
+        shards = [k for k in self.route.shards if k >= first]
+
+        def entries(k, parser):
+            p = parser.parse(self.route.path)
+            key = (k,) + p.key()
+            for entry in p.readdir(first_offset if k == first else 0):
+                if entry.name not in [".", ".."]:
+                    yield entry, key
+
+        for k, (entry, key) in self.parser.fan_out(shards, entries, ordered=True):
+            name = self.parser.get_name(k, entry.name)
+            ret = fuse.Direntry(name, offset=2 + entry.offset * n + k)
+            stat = getattr(entry, "stat", None)
+            if stat:
+                stat.st_ino = ret.ino = get_inode(key + (entry.name,))
+                ret.type = entry.type
+                ret.stat = stat
+            yield ret
+
+    def _readdir_merged(self):
+        for r in ".", "..":
+            yield fuse.Direntry(r)
+
+        def entries(k, parser):
+            for entry in parser.parse(self.route.path).readdir(0):
+                if entry.name not in [".", ".."]:
+                    yield entry
+
+        # The entries of every shard as they arrive, once
+        seen = set()
+        for _k, entry in self.parser.fan_out(self.route.shards, entries):
+            if entry.name in seen:
+                continue
+            seen.add(entry.name)
+            yield entry
+
+    def key(self):
+        if self.route.shard is not None:
+            return (self.route.shard,) + self.path.key()
+        return self.path.key()
+
+    def get_leaf(self):
+        return self.path.get_leaf()
+
+
+class UnionParser(ListingAttrs):
+    """
+    Resolves the paths of the union into UnionPath instances, with the
+    PathParser of every shard. The shards are queried at once by a pool of
+    threads
+    """
+
+    # Entries a shard sends at once while listing
+    batch_size = 100
+    # Batches of every shard waiting to be yielded
+    max_batches = 2
+    # Seconds a shard waits to send a batch before checking if the listing
+    # was stopped
+    put_timeout = 0.1
+
+    def __init__(self, parsers, cache_size=4096, workers=None):
+        self.parsers = parsers
+        # Routes of the paths that do not belong to a single shard
+        self.routes = PathCache(cache_size)
+        # Attributes of the entries of the listed directories, by directory
+        self.attrs = PathCache(cache_size)
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or len(parsers) * 4, thread_name_prefix="shard"
+        )
+
+    def get_name(self, shard, name):
+        return "{}-{}".format(shard, name)
+
+    def _split_name(self, name):
+        shard, sep, name = name.partition("-")
+        if not sep or not shard.isdigit() or int(shard) >= len(self.parsers):
+            raise FileNotFoundError
+        return int(shard), name
+
+    def fan_out(self, shards, fn, ordered=False):
+        """
+        Run fn(shard, parser) on every shard at once, the (shard, item) of the
+        items it returns are yielded in the order of the shards when
+        ordered, or as they arrive otherwise. The shards wait for the
+        batches they sent to be yielded
+        """
+        # The connections of the calling thread are given back first, the
+        # workers need them when the pools are small
+        self.release()
+        if ordered:
+            # Every shard waits for the previous ones to be listed
+            queues = {k: queue.Queue(self.max_batches) for k in shards}
+        else:
+            results = queue.Queue(self.max_batches * len(shards))
+            queues = {k: results for k in shards}
+        stopped = threading.Event()
+
+        def put(k, batch):
+            while not stopped.is_set():
+                try:
+                    queues[k].put((k, batch), timeout=self.put_timeout)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run(k):
+            parser = self.parsers[k]
+            try:
+                batch = []
+                for item in fn(k, parser):
+                    batch.append(item)
+                    if len(batch) == self.batch_size:
+                        if not put(k, batch):
+                            return
+                        batch = []
+                if put(k, batch):
+                    put(k, None)
+            except Exception as e:
+                put(k, e)
+            finally:
+                parser.release()
+
+        for k in shards:
+            self.executor.submit(run, k)
+        remaining = list(shards)
+        try:
+            while remaining:
+                k, batch = queues[remaining[0]].get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if batch is None:
+                    remaining.remove(k)
+                for item in batch or []:
+                    yield k, item
+        finally:
+            # Nothing else is needed when the listing stops early
+            stopped.set()
+
+    def _find(self, shards, path):
+        """
+        Shards that have the path and whether it lists ids
+        """
+
+        def find(k, parser):
+            try:
+                return [is_listing(parser.parse(path))]
+            except FileNotFoundError:
+                return []
+
+        found = list(self.fan_out(shards, find, ordered=True))
+        if not found:
+            raise FileNotFoundError
+        return tuple([k for k, _listing in found]), found[0][1]
+
+    def _resolve(self, path):
+        path = path.rstrip(os.path.sep) or os.path.sep
+        route = self.routes.get(path)
+        if route:
+            return route
+        if path == os.path.sep:
+            shards = tuple(range(len(self.parsers)))
+            route = Route(None, path, shards, False)
+        else:
+            parent_path, name = os.path.split(path)
+            parent = self._resolve(parent_path)
+            # Whether it exists is known once the shard parses it
+            if parent.shard is not None:
+                local = os.path.join(parent.path, name)
+                return Route(parent.shard, local, (parent.shard,), False)
+            if parent.listing:
+                shard, name = self._split_name(name)
+                if shard not in parent.shards:
+                    raise FileNotFoundError
+                local = os.path.join(parent.path, name)
+                return Route(shard, local, (shard,), False)
+            shards, listing = self._find(parent.shards, path)
+            route = Route(None, path, shards, listing)
+        self.routes.put(path, route)
+        return route
+
+    def _get_parser(self, shard):
+        used = getattr(self.local, "used", None)
+        if used is None:
+            used = self.local.used = set()
+        used.add(shard)
+        return self.parsers[shard]
+
+    def parse(self, path):
+        if not len(path):
+            raise FileNotFoundError
+        route = self._resolve(path)
+        shard = route.shard if route.shard is not None else route.shards[0]
+        return UnionPath(self, route, self._get_parser(shard).parse(route.path))
+
+    def get_path(self, shard, path):
+        """
+        Path of the union of a path of a shard
+        """
+        names = [n for n in path.split(os.path.sep) if n]
+        union = os.path.sep
+        for i, name in enumerate(names):
+            try:
+                route = self._resolve(union)
+            except FileNotFoundError:
+                route = None
+            if route and route.listing:
+                name = self.get_name(shard, name)
+                return os.path.join(union, name, *names[i + 1 :])
+            union = os.path.join(union, name)
+        return union
+
+    def invalidate(self, path=None, objects=None):
+        """
+        Forget the routes and the attributes below path, or everything. The
+        shards forget their own paths and objects
+        """
+        if path:
+            self.routes.invalidate(path)
+            self.attrs.invalidate(path)
+        elif not objects:
+            self.routes.clear()
+            self.attrs.clear()
+
+    def get_sizes(self):
+        sizes = [p.get_sizes() for p in self.parsers]
+        return {k: sum([s[k] for s in sizes]) for k in sizes[0]}
+
+    def release(self):
+        """
+        Give back the database connections the current thread used
+        """
+        used = getattr(self.local, "used", None)
+        while used:
+            self.parsers[used.pop()].release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,152 @@
+import logging
+import threading
+from collections import namedtuple
+
+from flumes.schema import File
+from sqlalchemy import create_engine, func
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import select
+
+from .db import is_sqlite_file
+from .registry import get_class_info, get_join_path, registry
+
+logger = logging.getLogger(__name__)
+
+# Changes on the table of a class. The rows are the primary keys of the
+# objects the new rows belong to, from the row up to its file, or None when
+# rows were updated or deleted and the whole table has to be considered
+Change = namedtuple("Change", ["cls", "rows"])
+
+
+class DatabaseWatcher(object):
+    """
+    Polls the source database for commits done by other processes, like
+    flumes scanning, and works out which tables changed and which rows were
+    added. Commits that only update rows change every table
+    """
+
+    # Number of new rows to track one by one, more are handled as a change
+    # of the whole table
+    max_rows = 1000
+
+    def __init__(self, schema, interval=1.0):
+        self.schema = schema
+        self.interval = interval
+        # The classes that own a table, the other ones share it
+        self.classes = [
+            info.cls for info in registry.values() if not info.cls.__mapper__.inherits
+        ]
+        self.snapshots = {}
+        self.listeners = []
+        self.engine = None
+        self.connection = None
+        self.data_version = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _create_engine(self):
+        engine = self.schema.source_engine
+        url = engine.url
+        if url.get_backend_name() == "sqlite" and not is_sqlite_file(url):
+            # Only the same engine sees an in-memory database
+            return engine
+        # Connections of its own, the pool is left to the requests
+        connect_args = {}
+        if url.get_backend_name() == "sqlite":
+            connect_args["check_same_thread"] = False
+        return create_engine(url, poolclass=NullPool, connect_args=connect_args)
+
+    def start(self):
+        self.engine = self._create_engine()
+        if self.engine.url.get_backend_name() == "sqlite":
+            # The version only changes for commits done on other connections
+            self.connection = self.engine.raw_connection()
+            self.data_version = self._get_data_version()
+        with self.engine.connect() as conn:
+            for cls in self.classes:
+                self.snapshots[cls] = self._get_snapshot(conn, cls)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.connection:
+            self.connection.close()
+        if self.engine and self.engine is not self.schema.source_engine:
+            self.engine.dispose()
+
+    def check(self):
+        """
+        Changes since the last check
+        """
+        if self.connection:
+            data_version = self._get_data_version()
+            if data_version == self.data_version:
+                return []
+            self.data_version = data_version
+        changes = []
+        with self.engine.connect() as conn:
+            for cls in self.classes:
+                snapshot = self._get_snapshot(conn, cls)
+                previous = self.snapshots[cls]
+                if snapshot == previous:
+                    continue
+                self.snapshots[cls] = snapshot
+                changes.append(Change(cls, self._get_new_rows(conn, cls, previous)))
+        if self.connection and not changes:
+            # Rows were updated in place, any table might have changed
+            changes = [Change(cls, None) for cls in self.classes]
+        return changes
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                changes = self.check()
+            except Exception:
+                logger.exception("Failed to check the database")
+                continue
+            if not changes:
+                continue
+            logger.info(
+                "Database changed: %s",
+                ", ".join([c.cls.__tablename__ for c in changes]),
+            )
+            for listener in self.listeners:
+                listener(changes)
+
+    def _get_data_version(self):
+        cursor = self.connection.cursor()
+        cursor.execute("PRAGMA data_version")
+        version = cursor.fetchone()[0]
+        cursor.close()
+        return version
+
+    def _get_snapshot(self, conn, cls):
+        pk = getattr(cls, get_class_info(cls).pk)
+        return tuple(conn.execute(select(func.max(pk), func.count(pk))).one())
+
+    def _get_new_rows(self, conn, cls, previous):
+        last, count = previous
+        pk = getattr(cls, get_class_info(cls).pk)
+        added = select(func.count(pk))
+        if last is not None:
+            added = added.where(pk > last)
+        added = conn.execute(added).scalar()
+        # Other rows were updated or deleted
+        if added != self.snapshots[cls][1] - count or added > self.max_rows:
+            return None
+        # Primary keys of every object from the new row to its file
+        path = get_join_path(cls, File) or []
+        targets = [cls] + [r.property.mapper.class_ for r in path]
+        stmt = select(*[getattr(t, get_class_info(t).pk) for t in targets])
+        stmt = stmt.select_from(cls)
+        for r in path:
+            stmt = stmt.join(r, isouter=True)
+        if last is not None:
+            stmt = stmt.where(pk > last)
+        return [list(zip(targets, row)) for row in conn.execute(stmt)]
@@ -1,11 +1,33 @@
-from datetime import datetime
+import asyncio
+import errno
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from stat import S_ISLNK
 
+import pytest
 from flumes.config import Config
 from flumes.options import Options
-from flumes.schema import Audio, File, Info, Schema, Video
+from flumes.schema import Audio, File, Info, Meta, Schema, Stream, Video
+from sqlalchemy import event
 
 from flumes_fuse import __version__
-from flumes_fuse.fs import Root
+from flumes_fuse.checksum import Checksums
+from flumes_fuse.db import Database
+from flumes_fuse.files import FileHandle, FilePool, Prefetcher
+from flumes_fuse.fs import FlumesFuse
+from flumes_fuse.index import ValueIndex
+from flumes_fuse.path import ExportHandle, PathParser, ResultPagesPath, TreeTablePath
+from flumes_fuse.registry import build_registry, get_class_info, parse_load_plan
+from flumes_fuse.stats import Stats
+from flumes_fuse.tree import ContentChecksum, FileContent, Root, Search
+from flumes_fuse.watch import DatabaseWatcher
 
 
 def test_version():
@@ -60,3 +82,860 @@ def test_root_path():
 
     # Assert that the actual content of root path coincides with the expected
     assert actual_root_path_content == expected_root_path_content
+
+
+def create_config(*args):
+    """Create a configuration, with sqlite in memory by default"""
+    options = Options()
+    return Config(options.parse_args(args or ["-i", "sqlite://", "-b", ":memory:"]))
+
+
+def create_schema(config=None, root=""):
+    """Create a schema with a dummy file entry in the media root"""
+    schema = Schema(config or create_config())
+
+    session = schema.create_session()
+    dummy_file = File(name="test.mp4", path="", mtime=datetime.now())
+    dummy_info = Info(
+        file=dummy_file,
+        video_streams=1,
+        audio_streams=1,
+        subtitle_streams=0,
+        seekable=True,
+        duration=5000000000,
+        live=False,
+    )
+    dummy_audio = Audio(
+        info=dummy_info, media_type="audio/mpeg", bitrate=131072, channels=2, depth=8
+    )
+    dummy_video = Video(
+        info=dummy_info, media_type="video/x-h264", width=1920, height=1080
+    )
+    session.add(Meta(version="0.1.4", root=root))
+    session.add(dummy_video)
+    session.add(dummy_audio)
+    session.commit()
+    return schema
+
+
+def test_path_cache():
+    """The purpose of this test is to verify that resolved paths are reused
+    until they are invalidated"""
+    schema = create_schema()
+    path_parser = PathParser(schema, Root, cache_size=2)
+
+    node = path_parser.parse("/files/1/info/duration")
+    assert path_parser.cache.misses == 1
+    assert path_parser.parse("/files/1/info/duration") is node
+    assert path_parser.cache.hits == 1
+    assert node.read(1024, 0) == b"5000000000"
+
+    # The cache is bounded
+    path_parser.parse("/files/1")
+    path_parser.parse("/files")
+    assert len(path_parser.cache) == 2
+    assert "/files/1/info/duration" not in path_parser.cache
+
+    # Invalidating a path removes everything below it
+    path_parser.invalidate("/files/1")
+    assert "/files/1" not in path_parser.cache
+    assert "/files" in path_parser.cache
+
+
+def test_session_objects():
+    """The purpose of this test is to verify that the objects loaded by a
+    thread are dropped once they exceed the budget"""
+    schema = create_schema()
+    path_parser = PathParser(schema, Root, max_objects=3)
+
+    node = path_parser.parse("/files/1/info")
+    assert path_parser.get_sizes() == {"objects": 2, "paths": 1}
+    path_parser.release()
+    assert path_parser.parse("/files/1/info") is node
+    path_parser.parse("/files/1/info/streams/1/media_type")
+    path_parser.release()
+    assert path_parser.get_sizes() == {"objects": 0, "paths": 0}
+    node = path_parser.parse("/files/1/info/streams/1/media_type")
+    assert node.read(1024, 0) == b"video/x-h264"
+
+
+def test_path_parser_threads(tmp_path):
+    """The purpose of this test is to verify that every thread resolves paths
+    with its own session"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    path_parser = PathParser(Database(config, pool_size=2), Root)
+    node = path_parser.parse("/files/1/info/duration")
+
+    nodes = []
+    thread = threading.Thread(
+        target=lambda: nodes.append(path_parser.parse("/files/1/info/duration"))
+    )
+    thread.start()
+    thread.join()
+
+    assert nodes[0] is not node
+    assert nodes[0].child_path.session is not node.child_path.session
+    assert nodes[0].read(1024, 0) == node.read(1024, 0)
+    path_parser.release()
+
+
+def test_file_content(tmp_path):
+    """The purpose of this test is to verify that the media content is read
+    through a pooled file descriptor"""
+    (tmp_path / "test.mp4").write_bytes(b"0123456789")
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config, root=str(tmp_path))
+    schema = Database(config)
+
+    pool = FilePool(size=1)
+    FileContent.pool = pool
+    path_parser = PathParser(schema, Root)
+    node = path_parser.parse("/files/1/contents")
+    assert node.getattr().st_size == 10
+
+    fh = node.open(os.O_RDONLY)
+    assert fh.read(4, 2) == b"2345"
+    assert node.read(4, 6) == b"6789"
+    assert len(pool) == 1
+    fh.release()
+    assert pool.files[fh.path][1] == 0
+
+
+def test_checksums(tmp_path, monkeypatch):
+    """The purpose of this test is to verify that the checksums of the media
+    files are computed once and kept until the file changes"""
+    media = tmp_path / "test.mp4"
+    media.write_bytes(b"0123456789")
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config, root=str(tmp_path))
+    schema = Database(config)
+    checksums = Checksums(tmp_path / "checksums.db", workers=2)
+    monkeypatch.setattr(ContentChecksum, "checksums", checksums)
+    path_parser = PathParser(schema, Root)
+
+    node = path_parser.parse("/files/1/contents.sha256")
+    digest = hashlib.sha256(b"0123456789").hexdigest()
+    assert node.getattr().st_size == 65
+    assert node.read(1024, 0) == digest.encode() + b"\n"
+    node = path_parser.parse("/files/1/contents.md5")
+    assert node.read(1024, 0) == hashlib.md5(b"0123456789").hexdigest().encode() + b"\n"
+    assert checksums.computed == 1
+    checksums.shutdown()
+
+    # The sidecar is used by the next mounts until the file changes
+    checksums = Checksums(tmp_path / "checksums.db")
+    path = str(media)
+    mtime = path_parser.parse("/files/1").child_path.obj.mtime
+    assert checksums.prewarm([(path, 10, mtime)]) == 0
+    assert checksums.prewarm([(path, 10, "mtime")]) == 1
+    assert checksums.get(path, 10, "mtime", "sha256") == digest
+    media.write_bytes(b"01234")
+    assert checksums.prewarm([(path, 5, "mtime")]) == 1
+    assert checksums.get(path, 5, "mtime", "sha256") != digest
+    checksums.shutdown()
+
+
+def test_readahead(tmp_path):
+    """The purpose of this test is to verify that sequential reads are served
+    from the read ahead buffers and seeks from the file"""
+    content = bytes(range(256)) * 1024
+    (tmp_path / "test.mp4").write_bytes(content)
+    prefetcher = Prefetcher(window=64 * 1024, memory=128 * 1024)
+    prefetcher.min_window = 4096
+    fh = FileHandle(FilePool(), str(tmp_path / "test.mp4"), prefetcher)
+
+    read = b""
+    while len(read) < len(content):
+        read += fh.read(1000, len(read))
+        assert prefetcher.used <= prefetcher.memory
+    assert read == content
+    assert fh.read(1000, len(content)) == b""
+
+    # A seek drops what was read ahead
+    assert fh.read(10, 5) == content[5:15]
+    assert not fh.readahead.chunks
+    fh.release()
+    assert prefetcher.used == 0
+    prefetcher.shutdown()
+
+
+def test_inodes(monkeypatch):
+    """The purpose of this test is to verify that the inodes are stable and
+    the timestamps come from the file entry, in UTC whatever the timezone"""
+    schema = create_schema()
+    session = schema.create_session()
+    session.get(File, 1).mtime = datetime(2022, 1, 31, 10, 0)
+    session.commit()
+    path_parser = PathParser(schema, Root)
+
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        assert path_parser.parse("/").getattr().st_ino == 1
+        st = path_parser.parse("/files/1/info/duration").getattr()
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert st.st_ino > 1
+    assert st.st_mtime == datetime(2022, 1, 31, 10, 0, tzinfo=timezone.utc).timestamp()
+    path_parser.invalidate()
+    assert path_parser.parse("/files/1/info/duration").getattr().st_ino == st.st_ino
+    assert path_parser.parse("/files/1/info").getattr().st_ino != st.st_ino
+    results = "/search/video/width/1920/results/1/info/duration"
+    assert path_parser.parse(results).getattr().st_ino != st.st_ino
+
+
+def test_registry():
+    """The purpose of this test is to verify the schema metadata gathered
+    for the mapped classes"""
+    build_registry()
+    info = get_class_info(Video)
+    assert info.pk == "id"
+    assert "width" in info.columns and "id" not in info.columns
+    assert info.all_columns[0] == "id"
+    assert "language" not in info.columns
+    assert info.relationships["fields"].uselist
+    assert get_class_info(File).relationships["info"].target == Info
+
+
+def test_readdir_table():
+    """The purpose of this test is to verify that tables are listed in batches
+    and the listing can be resumed from an offset"""
+    schema = create_schema()
+    session = schema.create_session()
+    for i in range(9):
+        info = Info(file=File(name="{}.mp4".format(i), path=""))
+        session.add(Video(info=info, width=1280 if i % 2 else 1920))
+    session.commit()
+    path_parser = PathParser(schema, Root)
+
+    node = path_parser.parse("/files")
+    node.child_path.batch_size = 4
+    entries = list(node.readdir(0))
+    assert [e.name for e in entries] == [".", ".."] + [str(i) for i in range(1, 11)]
+    resumed = list(node.readdir(entries[5].offset))
+    assert [e.name for e in resumed] == [e.name for e in entries[6:]]
+
+    node = path_parser.parse("/search/video/width/1920/results")
+    entries = [e.name for e in node.readdir(0)]
+    assert entries == [".", "..", "1", "2", "4", "6", "8", "10"]
+
+
+def test_readdir_attrs():
+    """The purpose of this test is to verify that the entries of an object
+    carry the attributes getattr returns, computed from the loaded object"""
+    schema = create_schema()
+    path_parser = PathParser(schema, Root)
+    for path in ["/files/1", "/files/1/info", "/files/1/info/streams"]:
+        entries = list(path_parser.parse(path).readdir(0))
+        path_parser.put_attrs(path, entries)
+        attrs = [e for e in entries if getattr(e, "stat", None)]
+        assert attrs
+        for e in attrs:
+            expected = path_parser.parse("{}/{}".format(path, e.name)).getattr()
+            stat = path_parser.get_attr("{}/{}".format(path, e.name))
+            assert stat is e.stat
+            assert e.type == expected.st_mode >> 12
+            for attr in ["st_ino", "st_mode", "st_size", "st_mtime"]:
+                assert getattr(stat, attr) == getattr(expected, attr)
+    assert path_parser.get_attr("/files/1/info/duration").st_size == 10
+    path_parser.invalidate("/files/1/info")
+    assert path_parser.get_attr("/files/1/info/duration") is None
+    assert path_parser.get_attr("/files/1/name")
+
+
+def test_value_index(tmp_path):
+    """The purpose of this test is to verify that searches are answered from
+    the sidecar index and it is refreshed with the new rows"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    schema = Database(config)
+    schema.index = ValueIndex(str(tmp_path / "index.db"), [Video, Audio])
+    assert not schema.index.ready
+    schema.index.refresh(schema)
+    assert schema.index.get_values(Video, "width") == [("1920", 1)]
+
+    session = Schema(config).create_session()
+    session.add(Video(info=Info(file=File(name="new.mp4", path="")), width=1920))
+    session.commit()
+    schema.index.refresh(schema)
+    assert schema.index.get_values(Video, "width") == [("1920", 2)]
+
+    path_parser = PathParser(schema, Root)
+    node = path_parser.parse("/search/video/width")
+    assert [e.name for e in node.readdir(0)] == [".", "..", "1920"]
+    # The same results as the search on the database
+    sql_parser = PathParser(Database(config), Root)
+    for search in ["video/width/1920", "video/width/1920/audio/channels/2"]:
+        path = "/search/{}/results".format(search)
+        node = path_parser.parse(path)
+        expected = [e.name for e in sql_parser.parse(path).readdir(0)]
+        assert [e.name for e in node.readdir(0)] == expected
+    node = path_parser.parse("/search/video/width/1920/results")
+    assert list(node.child_path.result_path.ids) == [1, 2]
+    try:
+        path_parser.parse("/search/video/width/1280")
+        assert False
+    except FileNotFoundError:
+        pass
+
+    # Updated rows are indexed again
+    session.query(Video).filter(Video.id == 1).update({"width": 1280})
+    session.commit()
+    schema.index.refresh(schema, [Video.__table__])
+    assert schema.index.get_values(Video, "width") == [("1280", 1), ("1920", 1)]
+    assert schema.index.get_files([(Video, "width", "1920")]) == [2]
+
+
+def test_search_results_cache(tmp_path):
+    """The purpose of this test is to verify that the ids matching a search
+    are queried once and used for the lookups below the results"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    schema = Database(config, results_memory=1024)
+    path_parser = PathParser(schema, Root)
+
+    node = path_parser.parse("/search/video/width/1920/results/1/info/duration")
+    assert node.read(1024, 0) == b"5000000000"
+    assert len(schema.results) == 1
+    assert list(node.child_path.result_path.ids) == [1]
+    node = path_parser.parse("/search/video/width/1920/results")
+    assert [e.name for e in node.readdir(0)] == [".", "..", "1"]
+    assert schema.results.hits == 1
+    try:
+        path_parser.parse("/search/video/width/1920/results/1/info/bogus")
+        assert False
+    except FileNotFoundError:
+        pass
+
+    # Results that do not fit are looked up by id, the search is not run
+    # again for every lookup
+    for results_memory in [0, 4]:
+        schema = Database(config, results_memory=results_memory)
+        path_parser = PathParser(schema, Root, cache_size=0)
+        statements = []
+        event.listen(
+            schema.engine, "before_cursor_execute", lambda *a: statements.append(a)
+        )
+        for i in range(2):
+            node = path_parser.parse("/search/video/width/1920/results/1/name")
+            assert node.read(1024, 0) == b"test.mp4"
+            assert node.child_path.result_path.ids is None
+        searches = [s for s in statements if "ORDER BY files.id" in s[2]]
+        assert len(searches) == bool(results_memory)
+        assert not len(schema.results)
+
+
+def test_search_pages(tmp_path, monkeypatch):
+    """The purpose of this test is to verify that the results of a search are
+    counted and split in pages named by their first id"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    session = Schema(config).create_session()
+    for i in range(4):
+        f = File(name="test-{}.mp4".format(i), path="", mtime=datetime.now())
+        info = Info(file=f, video_streams=2, audio_streams=0, subtitle_streams=0)
+        # Two matching streams, the file is counted once
+        Video(info=info, media_type="video/x-h264", width=1920)
+        Video(info=info, media_type="video/x-vp9", width=1920)
+        session.add(f)
+    session.commit()
+    monkeypatch.setattr(ResultPagesPath, "page_size", 2)
+
+    # Without cached results the pages are walked with keyset queries
+    for results_memory in [0, 1024]:
+        schema = Database(config, results_memory=results_memory)
+        path_parser = PathParser(schema, Root)
+        node = path_parser.parse("/search/video/width/1920/count")
+        assert node.read(1024, 0) == b"5\n"
+        assert node.getattr().st_size == 2
+        node = path_parser.parse("/search/video/width/1920/pages")
+        assert [e.name for e in node.readdir(0)] == [".", "..", "1", "3", "5"]
+        assert [e.name for e in node.readdir(4)] == ["3", "5"]
+        node = path_parser.parse("/search/video/width/1920/pages/3")
+        assert [e.name for e in node.readdir(0)] == [".", "..", "3", "4"]
+        node = path_parser.parse("/search/video/width/1920/pages/5/5/name")
+        assert node.read(1024, 0) == b"test-3.mp4"
+        for path in ["pages/6", "pages/x", "pages/1/3", "count/1"]:
+            with pytest.raises(FileNotFoundError):
+                path_parser.parse("/search/video/width/1920/" + path)
+        path_parser.parse("/search/video/width/1920/results")
+        assert bool(len(schema.results)) == bool(results_memory)
+
+
+def test_search_links(tmp_path, monkeypatch):
+    """The purpose of this test is to verify that the results of a search can
+    be links to the tree of the files"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    monkeypatch.setattr(Search, "link_results", True)
+    for results_memory in [0, 1024]:
+        schema = Database(config, results_memory=results_memory)
+        path_parser = PathParser(schema, Root)
+        node = path_parser.parse("/search/video/width/1920/results")
+        assert [e.name for e in node.readdir(0)] == [".", "..", "1"]
+        node = path_parser.parse("/search/video/width/1920/results/1")
+        assert S_ISLNK(node.getattr().st_mode)
+        assert node.readlink() == "../../../../../files/1"
+        node = path_parser.parse("/search/video/width/1920/pages/1/1")
+        assert node.readlink() == "../../../../../../files/1"
+        for path in ["results/2", "results/1/name"]:
+            with pytest.raises(FileNotFoundError):
+                path_parser.parse("/search/video/width/1920/" + path)
+    with pytest.raises(OSError):
+        path_parser.parse("/search/video/width/1920/results").readlink()
+
+
+def test_database_watcher(tmp_path):
+    """The purpose of this test is to verify that the commits of other
+    processes are detected with the rows they added"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    build_registry()
+    schema = Database(config, pool_size=1)
+    watcher = DatabaseWatcher(schema, interval=60)
+    watcher.start()
+    try:
+        # The connections of the requests are not used
+        assert schema.engine.pool.checkedout() == 0
+        assert watcher.check() == []
+
+        # Add new streams to the existing file from another connection
+        session = Schema(config).create_session()
+        info = session.get(Info, 1)
+        session.add(Audio(info=info, media_type="audio/x-opus", channels=6))
+        session.commit()
+        changes = watcher.check()
+        assert [c.cls for c in changes] == [Stream]
+        assert changes[0].rows == [[(Stream, 3), (Info, 1), (File, 1)]]
+        assert watcher.check() == []
+
+        # Deletions can not be tracked row by row
+        session.delete(session.get(Stream, 3))
+        session.commit()
+        assert watcher.check() == [(Stream, None)]
+    finally:
+        watcher.stop()
+
+
+def test_stats(tmp_path):
+    """The purpose of this test is to verify that the latencies and statements
+    of the operations are collected by the kind of path and exposed"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    create_schema(config)
+    schema = Database(config)
+    schema.stats = Stats()
+    path_parser = PathParser(schema, Root)
+
+    for op, path in [
+        ("getattr", "/files/1/info/duration"),
+        ("getattr", "/search/audio/channels"),
+        ("getattr", "/search/audio/channels/2"),
+    ]:
+        schema.stats.start(op)
+        p = path_parser.parse(path)
+        schema.stats.set_path(p)
+        p.getattr()
+        path_parser.release()
+        schema.stats.stop()
+
+    stats = json.loads(path_parser.parse("/.stats").read(65536, 0))
+    assert stats["ops"]["getattr"]["count"] == 3
+    assert stats["ops"]["getattr"]["sql"] > 0
+    assert stats["ops"]["getattr TreeTablePath"]["count"] == 1
+    assert stats["ops"]["getattr SearchTablePath"]["count"] == 1
+    assert stats["ops"]["getattr SearchPath"]["count"] == 1
+
+    # An open handle is read from a single render
+    handle = path_parser.parse("/.stats").open(os.O_RDONLY)
+    assert handle.direct_io
+    data = handle.read(16, 0)
+    schema.stats.start("getattr")
+    schema.stats.stop()
+    data += handle.read(65536, len(data))
+    assert json.loads(data)["ops"]["getattr"]["count"] == 3
+
+    # Nothing is counted once closed
+    schema.stats.close()
+    schema.stats.start("getattr")
+    path_parser.parse("/files/1/info/duration").getattr()
+    path_parser.invalidate()
+    path_parser.parse("/files/1/info/duration").getattr()
+    assert schema.stats.local.record.statements == 0
+    assert schema.stats.local.record.rows == 0
+
+
+def test_load_plan():
+    """The purpose of this test is to verify that the relationships are loaded
+    as planned when resolving an object and not just to list them"""
+    schema = create_schema()
+    statements = []
+    event.listen(
+        schema.engine, "before_cursor_execute", lambda *args: statements.append(1)
+    )
+
+    path_parser = PathParser(schema, Root)
+    entries = [e.name for e in path_parser.parse("/files/1/info").readdir(0)]
+    assert "streams" in entries
+    # The file and its info, the streams are not loaded to be listed
+    assert len(statements) == 2
+
+    try:
+        TreeTablePath.load_plan = parse_load_plan(
+            "File.info:joined;Info.streams:selectin"
+        )
+        statements.clear()
+        path_parser = PathParser(schema, Root)
+        node = path_parser.parse("/files/1/info/streams/2/media_type")
+        assert node.read(1024, 0) == b"audio/mpeg"
+        assert len(statements) == 2
+        # Only the items of the list can be reached
+        with pytest.raises(FileNotFoundError):
+            path_parser.parse("/files/1/info/streams/3")
+    finally:
+        TreeTablePath.load_plan = {}
+
+    with pytest.raises(ValueError):
+        parse_load_plan("File.info:eager")
+
+
+def test_record_file():
+    """The purpose of this test is to verify that an object and everything
+    below it can be read as JSON, and the sizes reported are in bytes"""
+    schema = create_schema()
+    session = schema.create_session()
+    session.add(File(name="canción.mp4", path="", mtime=datetime.now()))
+    session.commit()
+    path_parser = PathParser(schema, Root)
+
+    assert "record.json" in [e.name for e in path_parser.parse("/files/1").readdir(0)]
+    node = path_parser.parse("/files/1/record.json")
+    data = node.read(1 << 20, 0)
+    assert node.getattr().st_size == len(data)
+    assert node.read(10, 5) == data[5:15]
+    record = json.loads(data)
+    assert record["name"] == "test.mp4"
+    assert record["info"]["duration"] == 5000000000
+    assert sorted([s["type"] for s in record["info"]["streams"]]) == ["audio", "video"]
+
+    # What belongs to the file was loaded with it
+    node = path_parser.parse("/files/1/info/streams/2/record.json")
+    statements = []
+    event.listen(
+        schema.engine, "before_cursor_execute", lambda *args: statements.append(1)
+    )
+    record = json.loads(node.read(1 << 20, 0))
+    assert record["channels"] == 2
+    assert statements == []
+
+    node = path_parser.parse("/files/2/name")
+    assert node.getattr().st_size == len("canción.mp4".encode())
+    assert node.read(1024, 0) == "canción.mp4".encode()
+
+
+def test_export(tmp_path):
+    """The purpose of this test is to verify that tables and search results
+    are exported by reading them sequentially in batches"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    schema = create_schema(config)
+    session = schema.create_session()
+    session.add_all([File(name="{}.mp4".format(i), path="") for i in range(50)])
+    session.commit()
+    path_parser = PathParser(Database(config), Root)
+
+    node = path_parser.parse("/files.jsonl")
+    assert node.getattr().st_size == 0
+    handle = ExportHandle(
+        path_parser.session.get_bind(),
+        node.get_leaf().get_stmt(),
+        "jsonl",
+        File.id,
+        5,
+    )
+    data = b""
+    while True:
+        chunk = handle.read(64, len(data))
+        # Only a batch is kept in memory
+        assert len(handle.buffer) < 1024
+        if not chunk:
+            break
+        data += chunk
+        if len(data) == 64:
+            # Other processes can write while the export is open
+            db = sqlite3.connect(str(tmp_path / "flumes.db"), timeout=0)
+            db.execute("UPDATE files SET path = 'new' WHERE id = 51")
+            db.commit()
+            db.close()
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert [line["id"] for line in lines] == list(range(1, 52))
+    assert lines[0]["duration"] == 5000000000
+    assert lines[1]["duration"] is None
+    assert lines[-1]["path"] == "new"
+    # Reading from the start again runs the export again
+    assert handle.read(len(data), 0) == data
+    handle.release()
+
+    handle = path_parser.parse("/search/audio/channels/2/results.csv").open(0)
+    assert handle.read(4096, 0).decode().splitlines()[1].startswith("1,test.mp4,")
+    handle.release()
+
+    # Exports being read do not take the connections of the requests
+    path_parser = PathParser(Database(config, pool_size=1), Root)
+    handles = [path_parser.parse("/files.csv").open(0) for i in range(2)]
+    for handle in handles:
+        handle.read(64, 0)
+    path_parser.release()
+    assert path_parser.parse("/files/2/name").read(1024, 0) == b"0.mp4"
+    for handle in handles:
+        handle.release()
+
+
+def test_search_ranges():
+    """The purpose of this test is to verify that numeric and date fields can
+    be searched by ranges, listed in buckets when they have many values"""
+    schema = create_schema()
+    session = schema.create_session()
+    for i in range(100):
+        mtime = datetime(2020, 1, 1) + timedelta(days=3 * i)
+        f = File(name="{}.mp4".format(i), path="", mtime=mtime)
+        info = Info(file=f, duration=i * 10**9)
+        session.add(Video(info=info, width=1280 if i % 2 else 1920, height=720))
+    session.commit()
+    path_parser = PathParser(schema, Root)
+
+    # Few values are listed as they are
+    entries = [e.name for e in path_parser.parse("/search/video/width").readdir(0)]
+    assert entries == [".", "..", "1920", "1280"]
+
+    entries = [e.name for e in path_parser.parse("/search/info/duration").readdir(0)]
+    assert entries[2:5] == ["0..10s", "10s..20s", "20s..30s"]
+    node = path_parser.parse("/search/info/duration/10s..20s")
+    assert node.getattr().st_size == 10
+
+    results = path_parser.parse("/search/info/duration/>=90s/video/width/1920/results")
+    assert [e.name for e in results.readdir(0)][2:] == [
+        str(i + 2) for i in range(90, 100, 2)
+    ]
+    results = path_parser.parse("/search/info/duration/..2500ms/results")
+    assert [e.name for e in results.readdir(0)][2:] == ["2", "3", "4"]
+
+    entries = [e.name for e in path_parser.parse("/search/file/mtime").readdir(0)]
+    assert "2020-01-01..2021-01-01" in entries
+    results = path_parser.parse("/search/file/mtime/2020-03-01..2020-04-01/results")
+    assert len(list(results.readdir(0))) == 2 + 11
+
+    with pytest.raises(FileNotFoundError):
+        path_parser.parse("/search/info/duration/>=1x")
+
+    # An outlier widens the buckets instead of adding more
+    session.add(Info(file=File(name="broken.mp4", path=""), duration=10**18))
+    session.commit()
+    path_parser.invalidate()
+    entries = [e.name for e in path_parser.parse("/search/info/duration").readdir(0)]
+    assert len(entries) <= 2 + 16
+    assert entries[2].startswith("0..")
+
+
+def test_snapshot(tmp_path):
+    """The purpose of this test is to verify that the database can be served
+    from a copy in memory that is replaced when the source changes"""
+    config = create_config("-i", "sqlite:///{}".format(tmp_path / "flumes.db"))
+    source = create_schema(config)
+    schema = Database(config)
+    schema.load_snapshot([Video.__table__.c.width])
+    path_parser = PathParser(schema, Root)
+    assert path_parser.parse("/files/1/name").read(1024, 0) == b"test.mp4"
+    assert path_parser.parse("/search/video/width/1920/results/1")
+
+    session = source.create_session()
+    session.add(File(name="new.mp4", path=""))
+    session.commit()
+    with pytest.raises(FileNotFoundError):
+        path_parser.parse("/files/2")
+
+    schema.load_snapshot()
+    assert schema.generation == 2
+    assert path_parser.parse("/files/2/name").read(1024, 0) == b"new.mp4"
+
+    # Nothing is read from the source anymore
+    schema.source_engine.dispose()
+    os.remove(tmp_path / "flumes.db")
+    assert path_parser.parse("/files/1/info/duration").read(1024, 0) == b"5000000000"
+
+
+def test_async_backend(tmp_path, monkeypatch):
+    """The purpose of this test is to verify that the pyfuse3 backend serves
+    the tree by inode with the operations of the mount"""
+    pyfuse3 = pytest.importorskip("pyfuse3")
+    from flumes_fuse.aio import AsyncOperations
+
+    (tmp_path / "test.mp4").write_bytes(b"0123456789")
+    fs = FlumesFuse()
+    fs.uri = "sqlite:///{}".format(tmp_path / "flumes.db")
+    fs.watch_interval = 0
+    create_schema(create_config("-i", fs.uri), root=str(tmp_path))
+    fs.fsinit()
+    operations = AsyncOperations(
+        fs, {"attr_timeout": 1, "entry_timeout": 1, "negative_timeout": 2}
+    )
+    replies = []
+
+    def readdir_reply(token, name, attrs, next_id):
+        replies.append(name)
+        return True
+
+    monkeypatch.setattr(pyfuse3, "readdir_reply", readdir_reply)
+
+    async def serve():
+        files = await operations.lookup(pyfuse3.ROOT_INODE, b"files")
+        entry = await operations.lookup(files.st_ino, b"1")
+        await operations.readdir(entry.st_ino, 0, None)
+        contents = await operations.lookup(entry.st_ino, b"contents")
+        info = await operations.open(contents.st_ino, os.O_RDONLY, None)
+        data = await operations.read(info.fh, 2, 4)
+        await operations.release(info.fh)
+        assert info.keep_cache
+        # Files not invalidated when the database changes are not kept
+        stats = await operations.lookup(pyfuse3.ROOT_INODE, b".stats")
+        info = await operations.open(stats.st_ino, os.O_RDONLY, None)
+        assert not info.keep_cache and info.direct_io
+        await operations.release(info.fh)
+        # Failed lookups are cached for negative_timeout
+        missing = await operations.lookup(entry.st_ino, b"bogus")
+        assert missing.st_ino == 0 and missing.entry_timeout == 2
+        with pytest.raises(pyfuse3.FUSEError):
+            await operations.getattr(12345)
+        return data
+
+    try:
+        assert asyncio.run(serve()) == b"2345"
+        assert b"name" in replies and b"contents" in replies
+    finally:
+        operations.close()
+        fs.fsdestroy()
+
+
+def test_startup(tmp_path):
+    """The purpose of this test is to verify that the mount does not wait for
+    the database and the root is served right away"""
+    code = (
+        "import sys, time; start = time.perf_counter(); import flumes_fuse.fs; "
+        "print(time.perf_counter() - start, 'sqlalchemy' in sys.modules)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    elapsed, loaded = out.stdout.split()
+    assert float(elapsed) < 0.5
+    assert loaded == "False"
+
+    fs = FlumesFuse()
+    fs.uri = "sqlite:///{}".format(tmp_path / "flumes.db")
+    fs.watch_interval = 0
+    create_schema(create_config("-i", fs.uri))
+    start = time.perf_counter()
+    fs.fsinit()
+    try:
+        assert fs.getattr("/").st_ino == 1
+        assert fs.getattr("/files/1").st_nlink == 2
+        assert time.perf_counter() - start < 2
+        assert [n for n, _t in fs.profile.steps][:2] == ["imports", "database"]
+        assert fs.profile.first_op[0] == "getattr"
+    finally:
+        fs.fsdestroy()
+
+
+def test_union(tmp_path):
+    """The purpose of this test is to verify that several databases are served
+    as one tree, with the ids of every shard namespaced"""
+    uris = []
+    for shard in range(2):
+        root = tmp_path / str(shard)
+        root.mkdir()
+        (root / "test.mp4").write_bytes("shard {}".format(shard).encode())
+        uris.append("sqlite:///{}".format(tmp_path / "{}.db".format(shard)))
+        create_schema(create_config("-i", uris[-1]), root=str(root))
+    fs = FlumesFuse()
+    fs.uri = ";".join(uris)
+    fs.watch_interval = 0
+    # The shards are queried with the connections of the requests
+    fs.pool_size = 1
+    fs.fsinit()
+    try:
+        entries = list(fs.readdir("/files", 0))
+        assert [e.name for e in entries] == [".", "..", "0-1", "1-1"]
+        # A listing is resumed from the shard it stopped in
+        assert [e.name for e in fs.readdir("/files", entries[2].offset)] == ["1-1"]
+        assert fs.getattr("/files/0-1").st_ino != fs.getattr("/files/1-1").st_ino
+        for shard in range(2):
+            path = "/files/{}-1/contents".format(shard)
+            fh = fs.open(path, os.O_RDONLY)
+            assert fs.read(path, 1024, 0, fh) == "shard {}".format(shard).encode()
+            fs.release(path, os.O_RDONLY, fh)
+        for path in ["/files/1", "/files/2-1", "/files/0-2"]:
+            assert fs.getattr(path) == -errno.ENOENT
+
+        # The searches are run on every shard
+        search = "/search/video/width/1920"
+        names = [e.name for e in fs.readdir("/search/video/width", 0)]
+        assert names == [".", "..", "1920"]
+        assert fs.read(search + "/count", 1024, 0) == b"2\n"
+        names = [e.name for e in fs.readdir(search + "/results", 0)]
+        assert names == [".", "..", "0-1", "1-1"]
+        assert fs.read(search + "/results/1-1/name", 1024, 0) == b"test.mp4"
+        fh = fs.open(search + "/results.jsonl", os.O_RDONLY)
+        lines = fs.read(search + "/results.jsonl", 4096, 0, fh).splitlines()
+        fs.release(search + "/results.jsonl", os.O_RDONLY, fh)
+        assert [json.loads(line)["id"] for line in lines] == ["0-1", "1-1"]
+
+        # The shards listed later wait for the previous ones
+        parser = fs.path_parser
+        sent = []
+
+        def entries(k, _parser):
+            for i in range(100 * parser.batch_size):
+                sent.append(k)
+                yield i
+
+        listing = parser.fan_out([0, 1], entries, ordered=True)
+        assert next(listing) == (0, 0)
+        time.sleep(0.2)
+        assert sent.count(1) <= (parser.max_batches + 1) * parser.batch_size
+        listing.close()
+    finally:
+        fs.fsdestroy()
+
+
+def test_database_updates(tmp_path):
+    """The purpose of this test is to verify that the rows updated in place by
+    other processes are served once the database is checked"""
+    fs = FlumesFuse()
+    fs.uri = "sqlite:///{}".format(tmp_path / "flumes.db")
+    fs.watch_interval = 0
+    config = create_config("-i", fs.uri)
+    create_schema(config)
+    fs.fsinit()
+    fs.ready.wait()
+    watcher = DatabaseWatcher(fs.schema, interval=60)
+    watcher.start()
+    try:
+        assert fs.getattr("/files/1/info/duration").st_size == 10
+        assert fs.read("/files/1/name", 1024, 0) == b"test.mp4"
+        session = Schema(config).create_session()
+        session.get(Info, 1).duration = 7
+        session.get(File, 1).name = "new.mp4"
+        session.commit()
+        changes = watcher.check()
+        assert File in [c.cls for c in changes]
+        assert not [c for c in changes if c.rows is not None]
+        notified = []
+        fs.set_notifier(notified.append)
+        fs._database_changed(changes)
+        assert "/files" in notified
+        assert fs.getattr("/files/1/info/duration").st_size == 1
+        assert fs.read("/files/1/name", 1024, 0) == b"new.mp4"
+        assert watcher.check() == []
+    finally:
+        watcher.stop()
+        fs.fsdestroy()